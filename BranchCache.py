@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# @file   BranchCache.py
+# @author Matthieu Marinangeli (matthieu.marinangeli@epfl.ch)
+# @date   2020-03-23
+
+import hashlib
+import json
+import os
+import sys
+import warnings
+import numpy as np
+
+# Local cache of the branches read from ROOT files. The first time all the entries of a branch
+# of a tree are read from a file, the whole column is stored uncompressed as a .npy file, and
+# later reads memory-map it instead of decompressing the baskets again. Chunked reads of branches
+# not in the cache only read their chunk and do not fill the cache, so that they never hold a
+# whole column in memory; the cache is filled column by column in one explicit pass with `fill`
+# (or Tree.fillcache). Jagged (object) branches are never cached. A column is identified by the
+# path, modification time and size of the file, the tree and the branch, so modified files are
+# read again. The least recently used columns are removed when the cache gets larger than its
+# maximum size.
+#
+# The cache is used by Tree.iterTree, hence by readTree, mergefiles, GetHist and RooFit.DataSet,
+# when it is enabled with `enable` or the UTILITIES_BRANCH_CACHE environment variable, e.g.
+# UTILITIES_BRANCH_CACHE=20G. It is inspected and pruned with
+#
+#     python -m Utilities.BranchCache list
+#     python -m Utilities.BranchCache prune --max-size 5G
+
+_units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+def _parsesize(size):
+
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in _units:
+        return int(float(size[:-1]) * _units[size[-1]])
+    return int(size)
+
+def _formatsize(size):
+
+    for unit in ["T", "G", "M", "K"]:
+        if size >= _units[unit]:
+            return "{0:.1f}{1}".format(size / _units[unit], unit)
+    return "{0}B".format(size)
+
+_defaultsize = "10G"
+
+# UTILITIES_BRANCH_CACHE=1 (or yes, true, on) enables the cache with the default maximum size,
+# and e.g. UTILITIES_BRANCH_CACHE=20G with another one. The size is parsed on first use.
+_env = os.environ.get("UTILITIES_BRANCH_CACHE", "").strip()
+_switches = ("", "0", "no", "false", "off", "1", "yes", "true", "on")
+_settings = {"enabled": _env.lower() not in _switches[:5], "maxsize": None}
+
+def _maxsize():
+    
+    if _settings["maxsize"] is None:
+        size = _defaultsize if _env.lower() in _switches else _env
+        try:
+            _settings["maxsize"] = _parsesize(size)
+        except ValueError:
+            warnings.warn("Invalid UTILITIES_BRANCH_CACHE size {0!r}, using {1}".format(_env, _defaultsize))
+            _settings["maxsize"] = _parsesize(_defaultsize)
+            
+    return _settings["maxsize"]
+
+def cachedir():
+    """Directory of the caches of Utilities, $UTILITIES_CACHE or by default ~/.cache/Utilities."""
+
+    default = os.path.join(os.path.expanduser("~"), ".cache", "Utilities")
+    return os.environ.get("UTILITIES_CACHE", default)
+
+def _branchdir():
+    return os.path.join(cachedir(), "branches")
+
+def enable(maxsize=_defaultsize):
+    """Use the cache, keeping at most `maxsize` (bytes or e.g. "20G") of columns."""
+
+    _settings["enabled"] = True
+    _settings["maxsize"] = _parsesize(maxsize)
+
+def disable():
+    _settings["enabled"] = False
+
+def enabled():
+    return _settings["enabled"]
+
+def _key(file, treename, branch):
+
+    # files which can not be stat'ed (e.g. root:// urls) are not cached
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+
+    key = "{0}:{1}:{2}:{3}:{4}".format(os.path.abspath(file), st.st_mtime, st.st_size, treename, branch)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _load(key):
+
+    path = os.path.join(_branchdir(), key + ".npy")
+    try:
+        column = np.load(path, mmap_mode="r")
+    except (IOError, ValueError):
+        return None
+
+    # the modification time of a column is the time of its last use
+    os.utime(path, None)
+    return column
+
+def _store(key, column, info):
+
+    directory = _branchdir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = os.path.join(directory, key)
+    tmp = "{0}.{1}.npy".format(path, os.getpid())
+    np.save(tmp, np.ascontiguousarray(column), allow_pickle=False)
+    os.replace(tmp, path + ".npy")
+
+    with open(path + ".json", "w") as f:
+        json.dump(info, f)
+
+def _info(file, treename, branch):
+    return {"file": os.path.abspath(file), "tree": treename, "branch": branch}
+
+def read(file, treename, branches, reader, start=None, stop=None):
+    """
+    Structured array of `branches` of the entries `start` to `stop` of the tree `treename` of
+    `file`. The branches not in the cache are read with `reader(branches, start=, stop=)`. For a
+    read of all the entries they are then stored, while a chunked read (`start` or `stop` given)
+    only reads the chunk and leaves the cache untouched. Jagged (object) branches are never
+    cached, hence always read for the requested entries only.
+    """
+    
+    keys = [_key(file, treename, b) for b in branches]
+    if None in keys:
+        return reader(branches, start=start, stop=stop)
+        
+    columns = dict((b, _load(k)) for b, k in zip(branches, keys))
+    missing = [b for b in branches if columns[b] is None]
+    chunked = start is not None or stop is not None
+    
+    cached = [b for b in branches if b not in missing]
+    if cached:
+        start, stop, _ = slice(start, stop).indices(len(columns[cached[0]]))
+        for b in cached:
+            columns[b] = columns[b][start:stop]
+            
+    if missing:
+        array = reader(missing, start=start, stop=stop) if chunked or cached else reader(missing)
+        for b, k in zip(branches, keys):
+            if b not in missing:
+                continue
+            columns[b] = array[b]
+            if not chunked and not array[b].dtype.hasobject:
+                _store(k, array[b], _info(file, treename, b))
+        if not chunked:
+            prune(_maxsize())
+            
+    result = np.empty(len(columns[branches[0]]), dtype=[(b, columns[b].dtype, columns[b].shape[1:]) for b in branches])
+    for b in branches:
+        result[b] = columns[b]
+        
+    return result
+    
+def fill(file, treename, branches, reader):
+    """
+    Store the `branches` of the tree `treename` of `file` not in the cache yet, reading them one
+    at a time with `reader(branches)`, so that at most one column is in memory. Jagged (object)
+    branches are skipped. Return the list of the branches stored.
+    """
+    
+    stored = []
+    for b in branches:
+        k = _key(file, treename, b)
+        if k is None or _load(k) is not None:
+            continue
+        column = reader([b])[b]
+        if column.dtype.hasobject:
+            continue
+        _store(k, column, _info(file, treename, b))
+        stored.append(b)
+        
+    prune(_maxsize())
+    
+    return stored
+    
+def entries():
+    """List of the cached columns, most recently used first."""
+
+    directory = _branchdir()
+    if not os.path.isdir(directory):
+        return []
+
+    columns = []
+    for name in os.listdir(directory):
+        if not name.endswith(".npy"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        try:
+            with open(path[:-4] + ".json") as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            info = {}
+        info.update({"key": name[:-4], "size": st.st_size, "used": st.st_mtime})
+        columns.append(info)
+
+    return sorted(columns, key=lambda c: -c["used"])
+
+def _remove(key):
+
+    for ext in (".npy", ".json"):
+        try:
+            os.remove(os.path.join(_branchdir(), key + ext))
+        except OSError:
+            pass
+
+def prune(maxsize):
+    """Remove the least recently used columns until the cache is smaller than `maxsize`."""
+
+    maxsize = _parsesize(maxsize)
+    total = 0
+    removed = 0
+
+    for column in entries():
+        total += column["size"]
+        if total > maxsize:
+            _remove(column["key"])
+            removed += column["size"]
+
+    return removed
+
+def clear():
+    """Remove all the cached columns."""
+
+    for column in entries():
+        _remove(column["key"])
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Inspect and prune the branch cache of Utilities.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("list", help="list the cached columns, most recently used first")
+    _prune = subparsers.add_parser("prune", help="remove the least recently used columns")
+    _prune.add_argument("--max-size", default="10G", help="size to keep, e.g. 5G")
+    subparsers.add_parser("clear", help="remove all the cached columns")
+    args = parser.parse_args()
+
+    if args.command == "prune":
+        print("removed {0}".format(_formatsize(prune(args.max_size))))
+    elif args.command == "clear":
+        clear()
+    else:
+        columns = entries()
+        for c in columns:
+            print("{0:>8}  {1}:{2}/{3}".format(_formatsize(c["size"]), c.get("file", "?"), c.get("tree", "?"), c.get("branch", c["key"])))
+        print("{0} columns, {1} in {2}".format(len(columns), _formatsize(sum(c["size"] for c in columns)), _branchdir()))
+
+    sys.exit(0)
@@ -4,83 +4,261 @@
 # @date   2016-11-09
 
 from __future__ import division
-import ROOT
-from .Tree import readTree
+from .dependencies import softimport
+ROOT = softimport("ROOT")
+from .Tree import readTree, iterTree, globfiles, nentries
+from .Selection import compile_selection
+from . import Stats
+from concurrent.futures import ProcessPoolExecutor
 from array import *
 import numpy as np
-from hepunits import units
+units = softimport("hepunits.units", asname="units")
 from Utilities.utilities import destruct_objects
-from skhep.dataset.numpydataset import *
 
 
 import sys
-from rootpy.plotting import Hist, Graph, Hist2D, Profile, Hist3D
-import uproot
-import histbook
+rplot = softimport("rootpy.plotting", asname="rplot")
+uproot = softimport("uproot")
+histbook = softimport("histbook")
 
+def _isdataset(input):
+    
+    # skhep NumpyDataset, without importing scikit-hep
+    return type(input).__name__ == "NumpyDataset"
+
+class QuantileSketch(object):
+    """
+    Streaming, mergeable summary of a distribution from which quantiles are estimated, with a
+    rank error of about 1/`compression`. It is filled chunk by chunk (e.g. while filling
+    histograms) so that equal-frequency binnings are built without reading the data again.
+    """
+    
+    def __init__(self, compression=1000):
+        
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+        
+    def update(self, values, weights=None):
+        
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        else:
+            weights = np.asarray(weights, dtype=np.float64).ravel()
+            
+        keep = np.isfinite(values)
+        values, weights = values[keep], weights[keep]
+        if len(values) == 0:
+            return self
+            
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, weights]))
+        
+        return self
+        
+    def _compress(self, means, weights):
+        
+        # the points are merged into `compression` centroids of equal weight
+        order = np.argsort(means, kind="mergesort")
+        means, weights = means[order], weights[order]
+        cum = np.cumsum(weights)
+        total = cum[-1]
+        
+        group = np.minimum(((cum - weights/2) / total * self.compression).astype(np.intp), self.compression-1)
+        sumw = np.bincount(group, weights=weights)
+        summ = np.bincount(group, weights=weights*means)
+        filled = sumw > 0
+        
+        self.means = summ[filled] / sumw[filled]
+        self.weights = sumw[filled]
+        
+    def merge(self, other):
+        
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        
+        return self
+        
+    def quantile(self, q):
+        
+        cum = np.cumsum(self.weights)
+        positions = np.concatenate([[0.], (cum - self.weights/2) / cum[-1], [1.]])
+        means = np.concatenate([[self.min], self.means, [self.max]])
+        
+        return np.interp(q, positions, means)
+        
+def _finecounts(data, weights, xmin, xmax, nfine):
+    
+    data = np.asarray(data, dtype=np.float64)
+    xmin = np.nanmin(data) if xmin is None else xmin
+    xmax = np.nanmax(data) if xmax is None else xmax
+    
+    counts, edges = np.histogram(data, bins=nfine, range=(xmin, xmax), weights=weights)
+    
+    return counts.astype(np.float64), edges
+    
 class BinningScheme:
+    """
+    Bin edges between `xmin` and `xmax`, kept as a sorted array. Uniform, log-uniform bins and
+    single edges are added by hand, or the whole scheme is built from data with `fromQuantiles`
+    (equal-frequency bins), `fromBayesianBlocks` or `fromMinimumCounts`.
+    """
     
     def __init__(self, xmin, xmax):
-        self.Bins = [xmin,xmax]
+        self.edges = np.array([xmin,xmax], dtype=np.float64)
         self.Xmin = xmin
         self.Xmax = xmax
         
-    def addUniformBins(self, nBins, xmin, xmax):
-
-        overlap = False
-        common_min = False
-        common_max = False
+    @property
+    def Bins(self):
+        return self.edges.tolist()
         
-        for j in self.Bins:
-            if (j > xmin) and (j<xmax):
-                overlap = True
-                break
-            elif j == xmin:
-                common_min = True
-            elif j == xmax:
-                common_max = True
-                
-            
-        if not overlap:
-            unif_bins = []
-            bin_width = (xmax - xmin) / nBins
+    def _addrange(self, bins, xmin, xmax):
         
-            for i in xrange(nBins+1):
-                
-                if common_min and i == 0:
-                    continue
-                elif common_max and i == nBins:
-                    continue
-                    
-                unif_bins.append(xmin+(i)*bin_width)
-            
-            self.Bins = sorted(self.Bins + unif_bins)
-        else:
+        # no edge must be strictly inside the range, common boundaries are merged
+        if np.searchsorted(self.edges, xmin, side="right") < np.searchsorted(self.edges, xmax, side="left"):
             print("Can not include uniforms bins between "+str(xmin)+" and "+str(xmax)+" because another bin boundary is present in that range!")
             print(self.Bins)
+        else:
+            self.edges = np.union1d(self.edges, bins)
+            
+    def addUniformBins(self, nBins, xmin, xmax):
+        
+        self._addrange(np.linspace(xmin, xmax, nBins+1), xmin, xmax)
+        
+    def addLogUniformBins(self, nBins, xmin, xmax):
+        
+        self._addrange(np.geomspace(xmin, xmax, nBins+1), xmin, xmax)
             
     def addBin(self, UpperLimit):
         
-        if UpperLimit in self.Bins:
+        i = np.searchsorted(self.edges, UpperLimit)
+        if i < len(self.edges) and self.edges[i] == UpperLimit:
             "Bin limit already set!"
         else:
-            self.Bins = sorted(self.Bins+[UpperLimit])
+            self.edges = np.insert(self.edges, i, UpperLimit)
+            
+    def findBin(self, x):
+        """Bin numbers of values, as TAxis::FindBin: 0 is the underflow and nBins()+1 the overflow."""
+        
+        return np.searchsorted(self.edges, x, side="right")
         
     def ReturnArray(self,scale=1):
         
-        bins = [i*scale for i in self.Bins]
-        return array('d', bins)
+        return array('d', self.edges * scale)
         
     def ReturnBins(self,scale=1):
         
-        bins = [i*scale for i in self.Bins]
-        return bins
+        return (self.edges * scale).tolist()
         
     def nBins(self):
         
-        return len(self.Bins) - 1
-                    
-class EffHist(ROOT.TH1F):
+        return len(self.edges) - 1
+        
+    @classmethod
+    def fromEdges(cls, edges):
+        
+        edges = np.unique(np.asarray(edges, dtype=np.float64))
+        scheme = cls(edges[0], edges[-1])
+        scheme.edges = edges
+        
+        return scheme
+        
+    @classmethod
+    def fromQuantiles(cls, data, nBins, xmin=None, xmax=None, weights=None):
+        """
+        Bins with equal (weighted) numbers of entries, from an array of values or a QuantileSketch.
+        Bins which would be narrower than the precision of the sketch are merged.
+        """
+        
+        sketch = data if isinstance(data, QuantileSketch) else QuantileSketch().update(data, weights)
+        edges = sketch.quantile(np.linspace(0., 1., nBins+1))
+        
+        # the range replaces the outer edges (the minimum and maximum of the data)
+        if xmin is not None:
+            edges = np.concatenate([[xmin], edges[1:][edges[1:] > xmin]])
+        if xmax is not None:
+            edges = np.concatenate([edges[:-1][edges[:-1] < xmax], [xmax]])
+            
+        return cls.fromEdges(edges)
+        
+    @classmethod
+    def fromMinimumCounts(cls, data, mincount, xmin=None, xmax=None, weights=None, nfine=1000):
+        """
+        Merge `nfine` uniform bins from left to right until each bin holds at least `mincount`
+        (weighted) entries, the last bin being merged with the previous one if it holds less.
+        """
+        
+        counts, fine = _finecounts(data, weights, xmin, xmax, nfine)
+        
+        edges = [fine[0]]
+        content = 0.
+        for i, c in enumerate(counts):
+            content += c
+            if content >= mincount:
+                edges.append(fine[i+1])
+                content = 0.
+                
+        if edges[-1] != fine[-1]:
+            if len(edges) > 1:
+                edges[-1] = fine[-1]
+            else:
+                edges.append(fine[-1])
+                
+        return cls.fromEdges(edges)
+        
+    @classmethod
+    def fromBayesianBlocks(cls, data, p0=0.05, xmin=None, xmax=None, weights=None, nfine=1000):
+        """
+        Bayesian blocks (Scargle et al. 2013) of the data, with a false positive rate `p0` per
+        change point. The data are first histogrammed in `nfine` uniform bins.
+        """
+        
+        counts, fine = _finecounts(data, weights, xmin, xmax, nfine)
+        
+        # the cells are the non-empty fine bins, spanning the whole range
+        filled = np.nonzero(counts > 0)[0]
+        if len(filled) < 2:
+            return cls(fine[0], fine[-1])
+            
+        counts = counts[filled]
+        centers = (fine[filled] + fine[filled+1]) / 2
+        celledges = np.concatenate([[fine[0]], (centers[1:] + centers[:-1]) / 2, [fine[-1]]])
+        tail = celledges[-1] - celledges
+        
+        N = len(counts)
+        ncp_prior = 4 - np.log(73.53 * p0 * (counts.sum() ** -0.478))
+        
+        best = np.zeros(N)
+        last = np.zeros(N, dtype=np.intp)
+        
+        for R in range(N):
+            # fitness of the last block starting at each cell up to R
+            width = tail[:R+1] - tail[R+1]
+            n = np.cumsum(counts[:R+1][::-1])[::-1]
+            fitness = n * (np.log(n) - np.log(width)) - ncp_prior
+            fitness[1:] += best[:R]
+            
+            last[R] = np.argmax(fitness)
+            best[R] = fitness[last[R]]
+            
+        # change points, from the end
+        changepoints = []
+        i = N
+        while i > 0:
+            changepoints.append(i)
+            i = last[i-1]
+        changepoints.append(0)
+        
+        return cls.fromEdges(celledges[changepoints[::-1]])
+        
+class _EffHist(object):
+    # methods of EffHist, see `_effhist`
     
     def __init__(self, name, variable, scale=1, **kwargs):
         
@@ -107,6 +285,7 @@ class EffHist(ROOT.TH1F):
         self.hist_total = None
         self.selection = None
         self.input = None
+        self.effmap = None
         
     def addInput(self, input):
         #input tree with the events
@@ -117,27 +296,38 @@ class EffHist(ROOT.TH1F):
         self.hist_total = hist_total.Clone()
         self.hist_passed = hist_passed.Clone()
         
-        self.Divide(self.hist_passed,self.hist_total,1.0,1.0,"B")
-        self.Sumw2()
+        self.effmap = EfficiencyMap.fromhists(NumpyHist.fromhist(hist_total), NumpyHist.fromhist(hist_passed))
+        self._write()
         
     def addSelection(self, selection):
         
         if self.input is not None:
             self.selection = selection
             
-            self.hist_total = GetHist(self.input, self.var, self.name+"_Total", **self._kwargs)
-            self.hist_passed = GetHist(self.input, self.var, self.name+"_Passed", selection=self.selection, **self._kwargs)
-
-            self.Divide(self.hist_passed,self.hist_total,1.0,1.0,"B")
-            self.Sumw2()
+            # total and passed are filled in one pass, sharing the bin lookup
+            kwargs = dict(self._kwargs)
+            treename = kwargs.pop("treename", "DecayTree")
+            chunksize = kwargs.pop("chunksize", None)
+            kwargs.pop("nworkers", None)
+            
+            self.effmap = EfficiencyMap(self.var, {"passed": selection}, self.name, **kwargs)
+            self.effmap.fill(self.input, treename, chunksize)
+            
+            self.hist_total = self.effmap.total.toROOT(self.name+"_Total")
+            self.hist_passed = self.effmap.passed["passed"].toROOT(self.name+"_Passed")
+            self._write()
             
         else:
             raise NotImplementedError("Add and input first!")
+            
+    def _write(self):
+        
+        # binomial errors, as TH1::Divide with option "B"
+        self.effmap.efficiency().write(self)
         
-    def return_TGraphAsymmErrors(self, MPL=False):
+    def return_TGraphAsymmErrors(self, MPL=False, method="clopper_pearson", cl=Stats.ONE_SIGMA):
         
-        self.gr = ROOT.TGraphAsymmErrors()
-        self.gr.Divide(self.hist_passed,self.hist_total)
+        self.gr = self.effmap.toTGraphAsymmErrors(method=method, cl=cl)
 
         if self.Xaxis_name == "":
             self.gr.GetXaxis().SetTitle(self.var)
@@ -147,7 +337,7 @@ class EffHist(ROOT.TH1F):
         self.gr.SetFillStyle(1001)
             
         if MPL:
-            self.gr = Graph(self.gr)
+            self.gr = rplot.Graph(self.gr)
             self.gr.name = self.GetName()+"_graph"
             self.gr.title = self.GetTitle()
             yaxis = self.gr.yaxis
@@ -163,6 +353,22 @@ class EffHist(ROOT.TH1F):
         
     def delete(self):
         destruct_objects(self.hist_passed, self.hist_total, self.gr, self)
+        
+def _effhist():
+    
+    # EffHist derives from ROOT.TH1F, hence it is only created when first used such that
+    # importing this module does not load ROOT
+    if "EffHist" not in globals():
+        globals()["EffHist"] = type("EffHist", (_EffHist, ROOT.TH1F), {})
+        
+    return globals()["EffHist"]
+    
+def __getattr__(name):
+    
+    if name == "EffHist":
+        return _effhist()
+        
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
     
 def InputFile(file, selection, treename, debug=False):
     
@@ -211,76 +417,834 @@ def InputFile(file, selection, treename, debug=False):
 #        
 #    return hist
 
-def fill_hist(hist, array, weights = None):
+def _axis_edges(axis):
+    
+    nbins = axis.GetNbins()
+    return np.array([axis.GetBinLowEdge(i) for i in range(1, nbins+2)], dtype=np.float64)
+    
+def _findbin(edges, uniform, x):
+    
+    nbins = len(edges) - 1
+    x = np.asarray(x, dtype=np.float64)
+    
+    if uniform:
+        xmin, xmax = edges[0], edges[-1]
+        inrange = (x >= xmin) & (x < xmax)
+        idx = np.full(x.shape, nbins+1, dtype=np.intp)
+        idx[x < xmin] = 0
+        idx[inrange] = 1 + (nbins*(x[inrange] - xmin)/(xmax - xmin)).astype(np.intp)
+        # rounding may put values just below xmax in the overflow
+        return np.minimum(idx, np.where(inrange, nbins, nbins+1))
+    else:
+        # NaNs are sorted at the end, i.e. in the overflow bin as ROOT does
+        return np.searchsorted(edges, x, side="right")
+        
+# type of the bin contents of the histograms, from the TArray they inherit from
+_arraytypes = [("TArrayD", np.float64), ("TArrayF", np.float32), ("TArrayI", np.int32),
+               ("TArrayS", np.int16), ("TArrayC", np.int8)]
+
+def _frombuffer(buffer, dtype, count):
+    
+    # the buffers of older PyROOT versions have no size until it is set
+    if hasattr(buffer, "SetSize"):
+        buffer.SetSize(count)
+        
+    return np.frombuffer(buffer, dtype=dtype, count=count).astype(np.float64)
+    
+def _hist_arrays(hist, ncells):
+    
+    # contents and sums of squared weights (None without Sumw2) of the `ncells` bins, read from
+    # the buffers of the histogram. Profiles store sums, so their means and errors are read bin
+    # by bin.
+    if isinstance(hist, (ROOT.TProfile, ROOT.TProfile2D, ROOT.TProfile3D)):
+        sumw = np.array([hist.GetBinContent(i) for i in range(ncells)], dtype=np.float64)
+        sumw2 = np.array([hist.GetBinError(i)**2 for i in range(ncells)], dtype=np.float64)
+        return sumw, sumw2
+        
+    dtype = next(d for name, d in _arraytypes if isinstance(hist, getattr(ROOT, name)))
+    sumw = _frombuffer(hist.GetArray(), dtype, ncells)
+    if hist.GetSumw2N() == 0:
+        return sumw, None
+        
+    return sumw, _frombuffer(hist.GetSumw2().GetArray(), np.float64, ncells)
+    
+class ArrayHist(object):
+    """
+    NumPy accumulator for the bin contents of a 1D, 2D or 3D histogram.
+    
+    Bins are numbered as in ROOT, underflow and overflow included, so that the
+    accumulated sums can be written in one go into a TH1/TH2/TH3 with `write`.
+    """
+    
+    def __init__(self, edges, uniform=None):
+        
+        self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        if uniform is None:
+            uniform = [False] * len(self.edges)
+        self.uniform = list(uniform)
+        self.ncells = int(np.prod([len(e)+1 for e in self.edges]))
+        self.sumw = np.zeros(self.ncells)
+        self.sumw2 = np.zeros(self.ncells)
+        self.entries = 0
+        self.weighted = False
+        
+    @classmethod
+    def fromhist(cls, hist, contents=None):
+        
+        # the contents are read if the histogram has entries, or always with `contents`
+        axes = [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()][:hist.GetDimension()]
+        edges = [_axis_edges(a) for a in axes]
+        uniform = [a.GetXbins().GetSize() == 0 for a in axes]
+        
+        ret = cls(edges, uniform)
+        
+        if contents or (contents is None and hist.GetEntries() > 0):
+            ret.sumw, sumw2 = _hist_arrays(hist, ret.ncells)
+            if sumw2 is not None:
+                ret.sumw2 = sumw2
+                ret.weighted = True
+            else:
+                ret.sumw2 = ret.sumw.copy()
+            ret.entries = hist.GetEntries()
+            
+        return ret
+        
+    @property
+    def ndim(self):
+        return len(self.edges)
+        
+    def findbin(self, axis, x):
+        """Vectorized equivalent of TAxis::FindBin."""
+        
+        return _findbin(self.edges[axis], self.uniform[axis], x)
+            
+    def findbins(self, *coords):
+        """Global bin numbers, as TH1::FindBin, of arrays of coordinates."""
+        
+        bins = self.findbin(0, coords[0])
+        stride = len(self.edges[0]) + 1
+        for axis in range(1, self.ndim):
+            bins = bins + stride * self.findbin(axis, coords[axis])
+            stride *= len(self.edges[axis]) + 1
+            
+        return bins
         
-    if isinstance(weights, np.ndarray):
-        for a,w in np.nditer([array,weights]):
-            hist.Fill(a,w)
+    def fill(self, coords, weights=None):
+        
+        self.fillbins(self.findbins(*coords), weights)
+        
+    def fillbins(self, bins, weights=None):
+        """Fill global bin numbers, e.g. computed once with `findbins` for several histograms."""
+        
+        if weights is None:
+            counts = np.bincount(bins, minlength=self.ncells)
+            self.sumw += counts
+            self.sumw2 += counts
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            self.sumw += np.bincount(bins, weights=weights, minlength=self.ncells)
+            self.sumw2 += np.bincount(bins, weights=weights*weights, minlength=self.ncells)
+            self.weighted = True
+            
+        self.entries += len(bins)
+        
+    def compatible(self, other):
+        
+        return (self.ndim == other.ndim) and all(np.array_equal(a, b) for a, b in zip(self.edges, other.edges))
+        
+    def __iadd__(self, other):
+        
+        if not self.compatible(other):
+            raise ValueError("Can not add histograms with different binnings!")
+            
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self.entries += other.entries
+        self.weighted = self.weighted or other.weighted
+        
+        return self
+        
+    def write(self, hist):
+        """Write the accumulated contents and errors into a ROOT histogram."""
+        
+        hist.SetContent(np.ascontiguousarray(self.sumw))
+        
+        if self.weighted or hist.GetSumw2N() > 0:
+            if hist.GetSumw2N() == 0:
+                hist.Sumw2()
+            hist.SetError(np.ascontiguousarray(np.sqrt(self.sumw2)))
+            
+        hist.SetEntries(self.entries)
+        
+        return hist
+        
+class NumpyHist(ArrayHist):
+    """
+    Histogram held in NumPy arrays (edges, sums of weights and of squared weights, under- and
+    overflows included), with vectorized arithmetic. No ROOT object is created until `toROOT`.
+    """
+    
+    def __init__(self, edges, uniform=None, name="", title=""):
+        
+        ArrayHist.__init__(self, edges, uniform)
+        self.name = name
+        self.title = title or name
+        
+    @classmethod
+    def frombinning(cls, binnings, name="", title=""):
+        """Histogram from one `_binning` per axis, i.e. [nbins, xmin, xmax] or [edges]."""
+        
+        edges, uniform = [], []
+        for b in binnings:
+            if len(b) == 3:
+                edges.append(np.linspace(b[1], b[2], b[0]+1))
+                uniform.append(True)
+            else:
+                edges.append(np.asarray(b[0], dtype=np.float64))
+                uniform.append(False)
+                
+        return cls(edges, uniform, name, title)
+        
+    @classmethod
+    def fromhist(cls, hist, contents=None):
+        
+        ret = super(NumpyHist, cls).fromhist(hist, contents)
+        ret.name = ret.title = hist.GetName()
+        
+        return ret
+        
+    @property
+    def shape(self):
+        """Number of bins along each axis, without under- and overflows."""
+        return tuple(len(e) - 1 for e in self.edges)
+        
+    def _grid(self, values):
+        # global bin = bx + (nx+2)*(by + (ny+2)*bz), i.e. C order of the reversed axes
+        return values.reshape([len(e)+1 for e in self.edges][::-1])
+        
+    def _ingrid(self, values):
+        # bins without under- and overflows, indexed [x, y, z]
+        return self._grid(values)[(slice(1, -1),) * self.ndim].T
+        
+    @property
+    def contents(self):
+        return self._ingrid(self.sumw)
+        
+    @property
+    def errors(self):
+        return np.sqrt(self._ingrid(self.sumw2))
+        
+    def copy(self, name=None):
+        
+        ret = NumpyHist(self.edges, self.uniform, self.name if name is None else name, self.title)
+        ret.sumw = self.sumw.copy()
+        ret.sumw2 = self.sumw2.copy()
+        ret.entries = self.entries
+        ret.weighted = self.weighted
+        
+        return ret
+        
+    def __add__(self, other):
+        
+        ret = self.copy()
+        ret += other
+        return ret
+        
+    def __radd__(self, other):
+        
+        # sum() starts from 0
+        if other == 0:
+            return self.copy()
+        return self + other
+        
+    def scale(self, factor):
+        
+        self.sumw = self.sumw * factor
+        self.sumw2 = self.sumw2 * factor**2
+        self.weighted = self.weighted or factor != 1
+        
+        return self
+        
+    def divide(self, other, binomial=False, name=None):
+        """
+        Ratio of two histograms with the same binning. With `binomial` the entries of `self` are
+        a subset of the ones of `other` and the errors are binomial (weighted if needed).
+        """
+        
+        if not self.compatible(other):
+            raise ValueError("Can not divide histograms with different binnings!")
+            
+        ret = self.copy(name)
+        ret.sumw = Stats.efficiency(self.sumw, other.sumw)
+        ret.weighted = True
+        
+        if binomial and (self.weighted or other.weighted):
+            ret.sumw2 = Stats.weighted_error(self.sumw, other.sumw, self.sumw2, other.sumw2)**2
+        elif binomial:
+            ret.sumw2 = Stats.binomial_error(self.sumw, other.sumw)**2
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                b2 = np.where(other.sumw != 0, other.sumw**2, 1.)
+                ret.sumw2 = np.where(other.sumw != 0, self.sumw2/b2 + self.sumw**2 * other.sumw2/b2**2, 0.)
+                
+        return ret
+        
+    def rebin(self, ngroup, axis=0):
+        """Merge groups of `ngroup` consecutive bins along `axis`, the under- and overflows are kept."""
+        
+        nbins = len(self.edges[axis]) - 1
+        if nbins % ngroup != 0:
+            raise ValueError("{0} bins can not be merged in groups of {1}!".format(nbins, ngroup))
+            
+        gaxis = self.ndim - 1 - axis
+        
+        def merge(values):
+            grid = np.moveaxis(self._grid(values), gaxis, 0)
+            inner = grid[1:-1].reshape((nbins // ngroup, ngroup) + grid.shape[1:]).sum(axis=1)
+            grid = np.concatenate([grid[:1], inner, grid[-1:]])
+            return np.moveaxis(grid, 0, gaxis).ravel()
+            
+        ret = self.copy()
+        ret.edges = list(self.edges)
+        ret.edges[axis] = self.edges[axis][::ngroup]
+        ret.ncells = int(np.prod([len(e)+1 for e in ret.edges]))
+        ret.sumw = merge(self.sumw)
+        ret.sumw2 = merge(self.sumw2)
+        
+        return ret
+        
+    def project(self, axis=0):
+        """1D histogram along `axis`, summed over the other axes (under- and overflows included)."""
+        
+        gaxis = self.ndim - 1 - axis
+        others = tuple(a for a in range(self.ndim) if a != gaxis)
+        
+        ret = NumpyHist([self.edges[axis]], [self.uniform[axis]], self.name, self.title)
+        ret.sumw = self._grid(self.sumw).sum(axis=others)
+        ret.sumw2 = self._grid(self.sumw2).sum(axis=others)
+        ret.entries = self.entries
+        ret.weighted = self.weighted
+        
+        return ret
+        
+    def toROOT(self, name=None):
+        """TH1D, TH2D or TH3D with the binning and contents of the histogram."""
+        
+        name = self.name if name is None else name
+        # the TH2/TH3 constructors take either (n, low, high) or (n, edges) for all the axes
+        args = []
+        for e in self.edges:
+            if all(self.uniform):
+                args += [len(e)-1, e[0], e[-1]]
+            else:
+                args += [len(e)-1, np.ascontiguousarray(e, dtype=np.float64)]
+            
+        hist = getattr(ROOT, "TH{0}D".format(self.ndim))(name, self.title or name, *args)
+        
+        return self.write(hist)
+        
+class NumpyProfile(NumpyHist):
+    """
+    1D profile held in NumPy arrays: sums of w, w**2, w*y and w*y**2 per bin of x. It is
+    converted into a TProfile only with `toROOT`.
+    """
+    
+    def __init__(self, edges, uniform=None, name="", title=""):
+        
+        NumpyHist.__init__(self, edges, uniform, name, title)
+        self.sumwy = np.zeros(self.ncells)
+        self.sumwy2 = np.zeros(self.ncells)
+        
+    def fill(self, coords, weights=None):
+        
+        x, y = coords
+        y = np.asarray(y, dtype=np.float64)
+        bins = self.findbins(x)
+        w = np.ones(len(y)) if weights is None else np.asarray(weights, dtype=np.float64)
+        
+        self.sumw += np.bincount(bins, weights=w, minlength=self.ncells)
+        self.sumw2 += np.bincount(bins, weights=w*w, minlength=self.ncells)
+        self.sumwy += np.bincount(bins, weights=w*y, minlength=self.ncells)
+        self.sumwy2 += np.bincount(bins, weights=w*y*y, minlength=self.ncells)
+        self.weighted = self.weighted or weights is not None
+        self.entries += len(y)
+        
+    def __iadd__(self, other):
+        
+        NumpyHist.__iadd__(self, other)
+        self.sumwy += other.sumwy
+        self.sumwy2 += other.sumwy2
+        
+        return self
+        
+    def copy(self, name=None):
+        
+        ret = NumpyProfile(self.edges, self.uniform, self.name if name is None else name, self.title)
+        for attr in ("sumw", "sumw2", "sumwy", "sumwy2"):
+            setattr(ret, attr, getattr(self, attr).copy())
+        ret.entries = self.entries
+        ret.weighted = self.weighted
+        
+        return ret
+        
+    def _means(self):
+        # means and their errors for all the bins, under- and overflows included
+        
+        mean = Stats.efficiency(self.sumwy, self.sumw)
+        var = np.maximum(Stats.efficiency(self.sumwy2, self.sumw) - mean**2, 0.)
+        neff = Stats.efficiency(self.sumw**2, self.sumw2)
+        
+        return mean, np.sqrt(Stats.efficiency(var, neff))
+        
+    @property
+    def contents(self):
+        """Mean of y in each bin."""
+        return self._ingrid(self._means()[0])
+        
+    @property
+    def errors(self):
+        """Error on the mean of y in each bin, as TProfile with the default error option."""
+        return self._ingrid(self._means()[1])
+        
+    def toROOT(self, name=None):
+        
+        name = self.name if name is None else name
+        e = self.edges[0]
+        if self.uniform[0]:
+            hist = ROOT.TProfile(name, self.title or name, len(e)-1, e[0], e[-1])
+        else:
+            hist = ROOT.TProfile(name, self.title or name, len(e)-1, np.ascontiguousarray(e))
+        hist.Sumw2()
+        
+        # the TProfile stores sum(w*y) as bin contents, sum(w*y**2) in fSumw2, and sum(w) and
+        # sum(w**2) as bin entries
+        ROOT.TArrayD.Set(hist, self.ncells, np.ascontiguousarray(self.sumwy))
+        hist.GetSumw2().Set(self.ncells, np.ascontiguousarray(self.sumwy2))
+        hist.GetBinSumw2().Set(self.ncells, np.ascontiguousarray(self.sumw2))
+        for i in range(self.ncells):
+            hist.SetBinEntries(i, self.sumw[i])
+        hist.SetEntries(self.entries)
+        
+        return hist
+        
+def _selection_masks(selections):
+    
+    # columns to read and mask functions of selections, the ones which can not be compiled
+    # being read from ROOT as expression branches
+    columns, masks = [], []
+    for selection in selections:
+        if isinstance(selection, np.ndarray):
+            # mask (or entry numbers) of an array input
+            masks.append(lambda a, selection=selection: selection)
+            continue
+        try:
+            cut = compile_selection(selection)
+        except ValueError:
+            expr = "({0})".format(selection)
+            columns.append(expr)
+            masks.append(lambda a, expr=expr: a[expr] != 0)
+        except TypeError:
+            masks.append(lambda a, selection=np.asarray(selection): selection)
+        else:
+            columns += cut.branches
+            masks.append(cut.mask)
+            
+    return columns, masks
+    
+class EfficiencyMap(object):
+    """
+    Efficiencies of one or several selections, in bins of 1 to 3 variables, against the same
+    total. The total and passed counts (and sums of squared weights) are filled in one pass over
+    the input, computing the bins of each entry once. `selections` is a selection, a list of
+    selections or a dictionary of named selections. The binning is given as in GetHist (1D) or
+    Get2DHist/Get3DHist (binsx, binsy, binsz).
+    
+    >>> effmap = EfficiencyMap(["P", "ETA"], {"PID": "K_PIDK > 5"}, binsx=dict(bins=pbins), binsy=dict(nbins=4, xmin=2, xmax=5))
+    >>> effmap.fill(files, chunksize=1000000)
+    >>> eff, low, high = effmap.interval("PID", method="wilson")
+    """
+    
+    def __init__(self, variables, selections, name="", weights=None, **kwargs):
+        
+        self.variables = [variables] if isinstance(variables, str) else list(variables)
+        
+        if isinstance(selections, str):
+            selections = [selections]
+        if not isinstance(selections, dict):
+            selections = dict((s, s) for s in selections)
+        self.selections = list(selections.items())
+        self.weights = weights
+        self.name = name
+        
+        if len(self.variables) == 1:
+            binnings = [_binning(kwargs)]
+        else:
+            binnings = [_binning(kwargs[k]) for k in ["binsx", "binsy", "binsz"][:len(self.variables)]]
+            
+        self.total = NumpyHist.frombinning(binnings, name+"_Total")
+        self.passed = dict((n, NumpyHist.frombinning(binnings, "{0}_{1}".format(name, n))) for n, _ in self.selections)
+        
+    @classmethod
+    def fromhists(cls, total, passed):
+        """Efficiency map of filled histograms, `passed` being a histogram or a dictionary of them."""
+        
+        if not isinstance(passed, dict):
+            passed = {"passed": passed}
+            
+        effmap = cls.__new__(cls)
+        effmap.variables, effmap.weights, effmap.name = [], None, total.name
+        effmap.selections = [(n, None) for n in passed]
+        effmap.total = total
+        effmap.passed = dict(passed)
+        
+        return effmap
+        
+    def fill(self, input, treename='DecayTree', chunksize=None):
+        
+        columns, masks = _selection_masks([s for _, s in self.selections])
+        columns = self.variables + ([self.weights] if self.weights else []) + columns
+        columns = sorted(set(columns), key=columns.index)
+        
+        for array in _iterate_input(input, columns, "", treename, chunksize):
+            self.fillarray(array, masks)
+            
+        return self
+        
+    def fillarray(self, array, masks=None):
+        
+        if masks is None:
+            _, masks = _selection_masks([s for _, s in self.selections])
+            
+        bins = self.total.findbins(*[array[v] for v in self.variables])
+        w = np.asarray(array[self.weights], dtype=np.float64) if self.weights else None
+        
+        self.total.fillbins(bins, w)
+        for (name, _), mask in zip(self.selections, masks):
+            passed = mask(array)
+            self.passed[name].fillbins(bins[passed], None if w is None else w[passed])
+            
+    def _name(self, name):
+        
+        if name is None:
+            if len(self.passed) > 1:
+                raise ValueError("Several selections, give the name of one: {0}".format(list(self.passed)))
+            name = next(iter(self.passed))
+            
+        return name
+        
+    def efficiency(self, name=None):
+        """NumpyHist of the efficiency, with binomial (or weighted) errors."""
+        
+        name = self._name(name)
+        return self.passed[name].divide(self.total, binomial=True, name="{0}_{1}_eff".format(self.name, name))
+        
+    def interval(self, name=None, method="clopper_pearson", cl=Stats.ONE_SIGMA):
+        """
+        Efficiency and interval (low, high) in each bin, with `method` clopper_pearson, wilson,
+        bayesian, normal or weighted (weighted binomial errors). For weighted maps, the other
+        methods use the effective numbers of entries.
+        """
+        
+        passed, total = self.passed[self._name(name)], self.total
+        eff = Stats.efficiency(passed.sumw, total.sumw)
+        
+        if method == "weighted":
+            error = Stats.weighted_error(passed.sumw, total.sumw, passed.sumw2, total.sumw2)
+            low, high = np.clip(eff - error, 0., 1.), np.clip(eff + error, 0., 1.)
+        else:
+            if passed.weighted or total.weighted:
+                # effective number of entries of the total, sumw**2 / sumw2
+                ntotal = Stats.efficiency(total.sumw**2, total.sumw2)
+                npassed = eff * ntotal
+            else:
+                ntotal, npassed = total.sumw, passed.sumw
+            low, high = Stats.interval(npassed, ntotal, method, cl)
+            
+        return total._ingrid(eff), total._ingrid(low), total._ingrid(high)
+        
+    def toTGraphAsymmErrors(self, name=None, method="clopper_pearson", cl=Stats.ONE_SIGMA):
+        """TGraphAsymmErrors of a 1D efficiency, the bins without entries being skipped."""
+        
+        if self.total.ndim != 1:
+            raise ValueError("Only 1D efficiencies can be converted into a TGraphAsymmErrors!")
+            
+        eff, low, high = self.interval(name, method, cl)
+        edges = self.total.edges[0]
+        filled = self.total.contents > 0
+        
+        x = ((edges[1:] + edges[:-1]) / 2)[filled]
+        ex = ((edges[1:] - edges[:-1]) / 2)[filled]
+        y = eff[filled]
+        
+        c = lambda a: np.ascontiguousarray(a, dtype=np.float64)
+        
+        return ROOT.TGraphAsymmErrors(len(x), c(x), c(y), c(ex), c(ex), c(y - low[filled]), c(high[filled] - y))
+        
+class HistLookup(object):
+    """
+    Lookup table of the values and errors of a filled histogram (TH1/TH2/TH3, EffHist, NumpyHist
+    or EfficiencyMap), evaluated on arrays of coordinates, e.g. to apply an efficiency map as
+    per-candidate weights. It only holds NumPy arrays, so it can be pickled and sent to workers.
+    
+    `outofrange` sets what coordinates outside of the binning get: "clip" the nearest bin, "flow"
+    the under/overflow bins (as FindBin), "fill" `fill_value`. With `interpolate` the values are
+    linearly interpolated between bin centres, as TH1::Interpolate.
+    
+    >>> lookup = HistLookup.fromhist(effhist2d, outofrange="clip")
+    >>> weights, errors = lookup.lookup(array["P"], array["ETA"])
+    """
+    
+    def __init__(self, edges, values, errors=None, uniform=None, outofrange="clip", fill_value=np.nan, interpolate=False):
+        
+        if outofrange not in ("clip", "flow", "fill"):
+            raise ValueError("Unknown out of range mode {0}, use clip, flow or fill!".format(outofrange))
+            
+        self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        self.uniform = list(uniform) if uniform is not None else [False] * len(self.edges)
+        # values and errors are indexed [bx, by, bz], with the under- and overflows
+        self.values = np.asarray(values, dtype=np.float64)
+        self.errors = np.zeros(self.values.shape) if errors is None else np.asarray(errors, dtype=np.float64)
+        self.outofrange = outofrange
+        self.fill_value = fill_value
+        self.interpolate = interpolate
+        
+    @classmethod
+    def fromhist(cls, hist, name=None, **kwargs):
+        """Lookup table of a histogram, `name` being the selection of an EfficiencyMap."""
+        
+        if isinstance(hist, EfficiencyMap):
+            hist = hist.efficiency(name)
+            
+        if isinstance(hist, NumpyProfile):
+            edges, uniform = hist.edges, hist.uniform
+            values, errors = hist._means()
+        elif isinstance(hist, NumpyHist):
+            edges, uniform = hist.edges, hist.uniform
+            values, errors = hist.sumw, np.sqrt(hist.sumw2)
+        else:
+            # the contents are read even if the number of entries was not set
+            binning = ArrayHist.fromhist(hist, contents=True)
+            edges, uniform = binning.edges, binning.uniform
+            values = binning.sumw
+            errors = np.sqrt(binning.sumw2) if binning.weighted else np.sqrt(np.abs(binning.sumw))
+            
+        shape = [len(e)+1 for e in edges][::-1]
+        
+        return cls(edges, values.reshape(shape).T, errors.reshape(shape).T, uniform, **kwargs)
+        
+    @property
+    def ndim(self):
+        return len(self.edges)
+        
+    def _bins(self, coords):
+        
+        bins, outside = [], np.zeros(len(coords[0]), dtype=bool)
+        for axis, x in enumerate(coords):
+            b = _findbin(self.edges[axis], self.uniform[axis], x)
+            nbins = len(self.edges[axis]) - 1
+            outside |= (b == 0) | (b == nbins+1)
+            if self.outofrange != "flow":
+                b = np.clip(b, 1, nbins)
+            bins.append(b)
+            
+        return tuple(bins), outside
+        
+    def _interpolate(self, table, coords):
+        
+        lower, fractions = [], []
+        for axis, x in enumerate(coords):
+            edges = self.edges[axis]
+            centres = (edges[1:] + edges[:-1]) / 2
+            x = np.clip(x, centres[0], centres[-1])
+            i = np.clip(np.searchsorted(centres, x, side="right") - 1, 0, max(len(centres) - 2, 0))
+            upper = np.minimum(i + 1, len(centres) - 1)
+            width = np.where(upper > i, centres[upper] - centres[i], 1.)
+            lower.append(i)
+            fractions.append((x - centres[i]) / width)
+            
+        result = np.zeros(len(coords[0]))
+        # sum over the 2**ndim corners around each point, +1 for the underflow bins
+        for corner in np.ndindex(*([2] * self.ndim)):
+            weight = np.ones(len(coords[0]))
+            index = []
+            for axis, c in enumerate(corner):
+                nbins = len(self.edges[axis]) - 1
+                index.append(np.minimum(lower[axis] + c, nbins - 1) + 1)
+                weight *= fractions[axis] if c else 1. - fractions[axis]
+            result += weight * table[tuple(index)]
+            
+        return result
+        
+    def lookup(self, *coords):
+        """Values and errors at the coordinates, given per axis or as one (n, ndim) array."""
+        
+        if len(coords) == 1 and self.ndim > 1:
+            coords = _coordinates(coords[0])
+        coords = [np.asarray(x, dtype=np.float64) for x in coords]
+        
+        bins, outside = self._bins(coords)
+        
+        if self.interpolate:
+            values = self._interpolate(self.values, coords)
+            errors = self._interpolate(self.errors, coords)
+        else:
+            values = self.values[bins]
+            errors = self.errors[bins]
+            
+        if self.outofrange == "fill":
+            values = np.where(outside, self.fill_value, values)
+            errors = np.where(outside, self.fill_value, errors)
+            
+        return values, errors
+        
+    def __call__(self, *coords):
+        return self.lookup(*coords)[0]
+        
+    def error(self, *coords):
+        return self.lookup(*coords)[1]
+        
+def _coordinates(array):
+    
+    array = np.asarray(array)
+    if array.ndim == 1:
+        return [array]
     else:
-        for a in np.nditer(array):
-            hist.Fill(a)
+        return [array[:,i] for i in range(array.shape[1])]
+        
+def fill_hist(hist, array, weights = None):
+    
+    filler = ArrayHist.fromhist(hist)
+    filler.fill(_coordinates(array), weights)
+    filler.write(hist)
                 
 def fill_hist3d(hist, array, weights = None):
-
-    if isinstance(weights, np.ndarray):
-        for a0, a1, a2, w in np.nditer([array[:,0],array[:,1],array[:,2],weights]):
-            hist.Fill(a0, a1, a2, w)
+    
+    fill_hist(hist, array, weights)
+    
+def fill_profile(hist, array, weights = None):
+    
+    x = np.ascontiguousarray(array[:,0], dtype=np.float64)
+    y = np.ascontiguousarray(array[:,1], dtype=np.float64)
+    
+    if weights is None:
+        w = np.ones(len(x))
     else:
-        for a0, a1, a2 in np.nditer([array[:,0],array[:,1],array[:,2]]):
-            hist.Fill(a0, a1, a2)
+        w = np.ascontiguousarray(weights, dtype=np.float64)
         
-                
-def GetHist(input, variable, name="", selection="", treename='DecayTree', weights=None,  **kwargs):
-
-    if name == "":
-        name = variable
+    # TProfile::FillN loops in C++ over the entries
+    hist.FillN(len(x), x, y, w)
         
-    if weights:
-        branches = [variable,weights]
-    else:
-        branches = variable
                 
-    if isinstance(input,str) and (".root" in input):
-        array = root2array(input,treename,branches,selection)
+def _iterate_input(input, branches, selection, treename, chunksize=None):
+    
+    if isinstance(input,(list,tuple)) or (isinstance(input,str) and (".root" in input)):
+        for array in iterTree(input,treename,branches,selection,chunksize):
+            yield array
     elif isinstance(input,np.ndarray):
         if isinstance(input.dtype.names,tuple):
             if isinstance(selection, np.ndarray):
                 array = input[selection]
                 array = array[branches]
             else:
-                array = input[branches]
+                array = compile_selection(selection).apply(input, branches)
         else:
             array = input
+        yield array
+    elif _isdataset(input):
+        yield compile_selection(selection).apply(input, branches)
     elif isinstance(input,ROOT.TTree):
-        array = tree2array(input,branches,selection)
-    elif isinstance(input, NumpyDataset):
-        if selection != "":
-            array = input.select(selection)
-        else:
-            array = input
-        array = array[branches]
-                
-    if set(['nbins', 'xmin', 'xmax']).issubset(kwargs.keys()):
-        nbins, xmin, xmax = kwargs["nbins"], kwargs["xmin"], kwargs["xmax"]
-        hist = Hist(nbins,xmin,xmax,name=name,title=name,type='F')
+        # checked last, such that arrays are histogrammed without loading ROOT
+        for array in iterTree(input,treename,branches,selection,chunksize):
+            yield array
+    else:
+        raise ValueError("The input is not valid! It is a " + str(type(input)))
         
+def _binning(kwargs):
+    
+    if set(['nbins', 'xmin', 'xmax']).issubset(kwargs.keys()):
+        return [kwargs["nbins"], kwargs["xmin"], kwargs["xmax"]]
     elif set(['bin_scheme']).issubset(kwargs.keys()):
-        bin_scheme = kwargs["bin_scheme"]
-        hist = Hist(bin_scheme.ReturnBins(),name=name,title=name,type='F')
-        
+        return [kwargs["bin_scheme"].ReturnBins()]
     elif set(['bins']).issubset(kwargs.keys()):
-        bins = kwargs["bins"]
-        hist = Hist(bins,name=name,title=name,type='F')
+        return [kwargs["bins"]]
+    else:
+        raise NotImplementedError("Please provide some binning!")
+        
+def _fill_array(filler, input, variables, selection, treename, weights, chunksize, start=None, stop=None):
+    
+    if weights:
+        branches = variables + [weights]
+    else:
+        branches = variables
+        
+    if start is None and stop is None:
+        arrays = _iterate_input(input, branches, selection, treename, chunksize)
+    else:
+        arrays = iterTree(input, treename, branches, selection, chunksize, start, stop)
+        
+    for array in arrays:
+        if isinstance(array.dtype.names,tuple):
+            coords = [array[v] for v in variables]
+        else:
+            coords = _coordinates(array)
             
+        if weights:
+            filler.fill(coords, array[weights])
+        else:
+            filler.fill(coords)
+            
+    return filler
+    
+def _parallel_tasks(input, treename, nworkers):
+    
+    files = globfiles(input)
+    
+    if len(files) > 1:
+        return [(f, None, None) for f in files]
+    else:
+        # a single file is split in entry ranges
+        n = nentries(files[0], treename)
+        step = max(1, -(-n // nworkers))
+        return [(files[0], a, a+step) for a in range(0, n, step)]
+        
+def _fill(hist, input, variables, selection, treename, weights, chunksize, nworkers=None):
+    
     if weights:
         hist.Sumw2()
-        fill_hist(hist,array[variable],array[weights])
+        
+    filler = _fillarrays(ArrayHist.fromhist(hist), input, variables, selection, treename, weights, chunksize, nworkers)
+            
+    return filler.write(hist)
+    
+def _fillarrays(filler, input, variables, selection, treename, weights, chunksize, nworkers=None):
+    
+    if nworkers and (isinstance(input,(list,tuple)) or isinstance(input,str)):
+        # each worker fills a NumPy partial histogram, which are summed here in the order of the tasks
+        with ProcessPoolExecutor(nworkers) as executor:
+            futures = [executor.submit(_fill_array, ArrayHist(filler.edges, filler.uniform), f, variables, selection,
+                                       treename, weights, chunksize, start, stop)
+                       for f, start, stop in _parallel_tasks(input, treename, nworkers)]
+            for future in futures:
+                filler += future.result()
     else:
-        fill_hist(hist,array)
+        _fill_array(filler, input, variables, selection, treename, weights, chunksize)
+            
+    return filler
+                
+def GetHist(input, variable, name="", selection="", treename='DecayTree', weights=None, chunksize=None, nworkers=None, asnumpy=False, **kwargs):
+
+    if name == "":
+        name = variable
+        
+    if asnumpy:
+        filler = NumpyHist.frombinning([_binning(kwargs)], name)
+        return _fillarrays(filler, input, [variable], selection, treename, weights, chunksize, nworkers)
+        
+    hist = rplot.Hist(*_binning(kwargs),name=name,title=name,type='F')
     
-    return hist
+    return _fill(hist, input, [variable], selection, treename, weights, chunksize, nworkers)
     
-def GetProfile(input, variable_x, variable_y, name="", selection="", treename='DecayTree', weights=None, **kwargs):
+def GetProfile(input, variable_x, variable_y, name="", selection="", treename='DecayTree', weights=None, chunksize=None, asnumpy=False, **kwargs):
     
     #1 nbins, xmin, xmax
     #2 BinningScheme
@@ -295,36 +1259,34 @@ def GetProfile(input, variable_x, variable_y, name="", selection="", treename='D
         else: raise ValueError()
     else: raise ValueError()
     
-    hist = Profile(*params,name=name,title=name)
+    if asnumpy:
+        hist = NumpyProfile.frombinning([params],name)
+    else:
+        hist = rplot.Profile(*params,name=name,title=name)
         
     if weights:
+        if not asnumpy:
+            hist.Sumw2()
         branches = [variable_x,variable_y,weights]
     else:
         branches = [variable_x,variable_y]
-    
-    if isinstance(input,str) and (".root" in input):
-        array = root2array(input,treename,branches,selection)
-    elif isinstance(input,np.ndarray):
-        if isinstance(selection, np.ndarray):
-            array = input[selection]
-            array = array[branches]
-        else:
-            array = input[branches]
-    elif isinstance(input,ROOT.TTree):
-        array = tree2array(input,branches,selection)
         
-    variable_x = array[variable_x]*scale_x
-    variable_y = array[variable_y]*scale_y
+    for array in _iterate_input(input, branches, selection, treename, chunksize):
         
-    array = np.zeros((len(array),2))
-    array[:,0] = variable_x
-    array[:,1] = variable_y
+        array_to_fill = np.zeros((len(array),2))
+        array_to_fill[:,0] = array[variable_x]*scale_x
+        array_to_fill[:,1] = array[variable_y]*scale_y
         
-    fill_profile(hist,array)
+        if asnumpy:
+            hist.fill([array_to_fill[:,0], array_to_fill[:,1]], array[weights] if weights else None)
+        elif weights:
+            fill_profile(hist,array_to_fill,array[weights])
+        else:
+            fill_profile(hist,array_to_fill)
     
     return hist
     
-def Get2DHist(input, variables, name, selection="", treename='DecayTree', weights=None, scale = 1.,  **kwargs):
+def Get2DHist(input, variables, name, selection="", treename='DecayTree', weights=None, scale = 1., chunksize=None, nworkers=None, asnumpy=False, **kwargs):
         
     if not isinstance(variables, list) and len(variables) == 2:
         raise NotImplementedError("Remember that you are filling a 2D histogram!")
@@ -332,137 +1294,288 @@ def Get2DHist(input, variables, name, selection="", treename='DecayTree', weight
     if not set(['binsx', 'binsy']).issubset(kwargs.keys()):
         raise NotImplementedError("Please provide some binnings for each variable!")
         
-    varx, vary= variables[0], variables[1]
-    bins = [kwargs["binsx"], kwargs["binsy"]]
+    BINS = _binning(kwargs["binsx"]) + _binning(kwargs["binsy"])
         
-    if weights:
-        branches = variables + [weights]
-    else:
-        branches = variables
-                
-    if isinstance(input,str) and (".root" in input):
-        array = root2array(input,treename,branches,selection)
-    elif isinstance(input,np.ndarray):
-        if isinstance(input.dtype.names,tuple):
-            if isinstance(selection, np.ndarray):
-                array = input[selection]
-                array = array[branches]
-            else:
-                array = input[branches]
-        else:
-            array = input
-    elif isinstance(input,ROOT.TTree):
-        array = tree2array(input,branches,selection)
+    if asnumpy:
+        filler = NumpyHist.frombinning([_binning(kwargs["binsx"]), _binning(kwargs["binsy"])], name)
+        return _fillarrays(filler, input, variables, selection, treename, weights, chunksize, nworkers)
         
-    BINS = []
+    hist = rplot.Hist2D(*BINS,name=name,title=name,type='F')
+    
+    return _fill(hist, input, variables, selection, treename, weights, chunksize, nworkers)
         
-    for b in bins:
-        if set(['nbins', 'xmin', 'xmax']).issubset(b.keys()):
-            nbins, xmin, xmax = b["nbins"], b["xmin"], b["xmax"]
-            BINS += [nbins, xmin, xmax]
+def Get3DHist(input, variables, name, selection="", treename='DecayTree', weights=None, scale = 1., chunksize=None, nworkers=None, asnumpy=False, **kwargs):
         
-        elif set(['bin_scheme']).issubset(b.keys()):
-            bin_scheme = b["bin_scheme"]
-            BINS.append(bin_scheme.ReturnBins())
-            
-        elif set(['bins']).issubset(b.keys()):
-            bins = b["bins"]
-            BINS.append(bins)
+    if not isinstance(variables, list) and len(variables) == 3:
+        raise NotImplementedError("Remember that you are filling a 3D histogram!")
+        
+    if not set(['binsx', 'binsy', 'binsz']).issubset(kwargs.keys()):
+        raise NotImplementedError("Please provide some binnings for each variable!")
+        
+    BINS = _binning(kwargs["binsx"]) + _binning(kwargs["binsy"]) + _binning(kwargs["binsz"])
+        
+    if asnumpy:
+        filler = NumpyHist.frombinning([_binning(kwargs["binsx"]), _binning(kwargs["binsy"]), _binning(kwargs["binsz"])], name)
+        return _fillarrays(filler, input, variables, selection, treename, weights, chunksize, nworkers)
         
-    hist = Hist2D(*BINS,name=name,title=name,type='F')
+    hist = rplot.Hist3D(*BINS,name=name,title=name,type='F')
     
-    array_to_fill = np.empty((len(array),2))
+    return _fill(hist, input, variables, selection, treename, weights, chunksize, nworkers)
     
-    array_to_fill[:,0] = array[varx]
-    array_to_fill[:,1] = array[vary]
+
+class HistBooker(object):
+    """
+    Book many histograms, each with its own variables, binning, weights and selection, and fill
+    them all in a single pass over the input. The union of the needed branches, including the ones
+    used in the selections, is read once and every distinct selection is evaluated once per chunk.
     
-    if weights:
-        hist.Sumw2()
-        fill_hist(hist,array_to_fill,array[weights])
-    else:
-        fill_hist(hist,array_to_fill)
+    >>> booker = HistBooker()
+    >>> booker.book("B_M", "B_M", nbins=100, xmin=5000, xmax=5600, selection="B_PT > 1000")
+    >>> booker.book2D("B_PT_ETA", ["B_PT", "B_ETA"], binsx=dict(bins=[0, 5e3, 1e4]), binsy=dict(nbins=5, xmin=2, xmax=5))
+    >>> hists = booker.fill("file.root", chunksize=1000000)
+    """
+    
+    def __init__(self):
+        
+        self._bookings = []
+        self.hists = {}
+        
+    def _book(self, name, hist, variables, selection, weights, kind="hist"):
+        
+        if name in self.hists:
+            raise ValueError("A histogram named {0} is already booked!".format(name))
             
-    return hist
+        if weights:
+            hist.Sumw2()
+            
+        self._bookings.append({"hist": hist, "variables": variables, "selection": selection,
+                               "weights": weights, "kind": kind})
+        self.hists[name] = hist
         
-def Get3DHist(input, variables, name, selection="", treename='DecayTree', weights=None, scale = 1.,  **kwargs):
+        return hist
         
-    if not isinstance(variables, list) and len(variables) == 3:
-        raise NotImplementedError("Remember that you are filling a 3D histogram!")
+    def book(self, name, variable, selection="", weights=None, **kwargs):
         
-    if not set(['binsx', 'binsy', 'binsz']).issubset(kwargs.keys()):
-        raise NotImplementedError("Please provide some binnings for each variable!")
+        hist = rplot.Hist(*_binning(kwargs),name=name,title=name,type='F')
+        return self._book(name, hist, [variable], selection, weights)
         
-    varx, vary, varz = variables[0], variables[1], variables[2]
-    bins = [kwargs["binsx"], kwargs["binsy"], kwargs["binsz"]]
+    def book2D(self, name, variables, selection="", weights=None, **kwargs):
         
-    if weights:
-        branches = variables + [weights]
-    else:
-        branches = variables
+        BINS = _binning(kwargs["binsx"]) + _binning(kwargs["binsy"])
+        hist = rplot.Hist2D(*BINS,name=name,title=name,type='F')
+        return self._book(name, hist, variables, selection, weights)
+        
+    def book3D(self, name, variables, selection="", weights=None, **kwargs):
+        
+        BINS = _binning(kwargs["binsx"]) + _binning(kwargs["binsy"]) + _binning(kwargs["binsz"])
+        hist = rplot.Hist3D(*BINS,name=name,title=name,type='F')
+        return self._book(name, hist, variables, selection, weights)
+        
+    def bookProfile(self, name, variable_x, variable_y, selection="", weights=None, **kwargs):
+        
+        hist = rplot.Profile(kwargs["nbins"],kwargs["xmin"],kwargs["xmax"],name=name,title=name)
+        return self._book(name, hist, [variable_x, variable_y], selection, weights, kind="profile")
+        
+    def bookEff(self, name, variable, selection, weights=None, **kwargs):
+        
+        effhist = _effhist()(name, variable, **kwargs)
+        effhist.selection = selection
+        
+        hist_total = rplot.Hist(*_binning(kwargs),name=name+"_Total",title=name+"_Total",type='F')
+        hist_passed = rplot.Hist(*_binning(kwargs),name=name+"_Passed",title=name+"_Passed",type='F')
+        self._bookings.append({"hist": hist_total, "variables": [variable], "selection": "",
+                               "weights": weights, "kind": "hist"})
+        self._bookings.append({"hist": hist_passed, "variables": [variable], "selection": selection,
+                               "weights": weights, "kind": "hist"})
+        self._bookings.append({"hist": effhist, "total": hist_total, "passed": hist_passed, "kind": "eff"})
+        self.hists[name] = effhist
+        
+        return effhist
+        
+    def branches(self):
+        
+        branches = []
+        for b in self._bookings:
+            for v in b.get("variables", []) + [b.get("weights")]:
+                if v and v not in branches:
+                    branches.append(v)
+                    
+        return branches
+        
+    def selections(self):
+        
+        selections = []
+        for b in self._bookings:
+            s = b.get("selection", "")
+            if isinstance(s, str) and s != "" and s not in selections:
+                selections.append(s)
                 
-    if isinstance(input,str) and (".root" in input):
-        array = root2array(input,treename,branches,selection)
-    elif isinstance(input,np.ndarray):
-        if isinstance(input.dtype.names,tuple):
-            if isinstance(selection, np.ndarray):
-                array = input[selection]
-                array = array[branches]
+        return selections
+        
+    def _fill_chunk(self, fillers, select):
+        
+        selected = {}
+        
+        for b, filler in zip(self._bookings, fillers):
+            if b["kind"] == "eff":
+                continue
+                
+            selection = b["selection"]
+            key = selection if isinstance(selection, str) else id(selection)
+            if key not in selected:
+                selected[key] = select(selection)
+            array = selected[key]
+            
+            coords = [array[v] for v in b["variables"]]
+            weights = array[b["weights"]] if b["weights"] else None
+            
+            if b["kind"] == "profile":
+                fill_profile(b["hist"], np.column_stack(coords), weights)
             else:
-                array = input[branches]
-        else:
-            array = input
-    elif isinstance(input,ROOT.TTree):
-        array = tree2array(input,branches,selection)
-    elif isinstance(input, NumpyDataset):
-        if selection != "":
-            array = input.select(selection)
-        else:
-            array = input
-        array = array[branches]
+                filler.fill(coords, weights)
         
-    BINS = []
+    def fill(self, input, treename='DecayTree', chunksize=None):
+        """Fill all the booked histograms in one pass over the input and return them."""
         
-    for b in bins:
-        if set(['nbins', 'xmin', 'xmax']).issubset(b.keys()):
-            nbins, xmin, xmax = b["nbins"], b["xmin"], b["xmax"]
-            BINS += [nbins, xmin, xmax]
+        fillers = [ArrayHist.fromhist(b["hist"]) if b["kind"] == "hist" else None for b in self._bookings]
+        branches = self.branches()
         
-        elif set(['bin_scheme']).issubset(b.keys()):
-            bin_scheme = b["bin_scheme"]
-            BINS.append(bin_scheme.ReturnBins())
+        # selections which can not be compiled are read as expression branches
+        selections = self.selections()
+        extra, masks = _selection_masks(selections)
+        masks = dict(zip(selections, masks))
+        columns = branches + [c for i, c in enumerate(extra) if c not in branches and c not in extra[:i]]
+        
+        def select(array, selection):
+            if isinstance(selection, np.ndarray):
+                return array[selection]
+            if selection in masks:
+                return array[masks[selection](array)]
+            return array
             
-        elif set(['bins']).issubset(b.keys()):
-            bins = b["bins"]
-            BINS.append(bins)
+        if isinstance(input, np.ndarray) or _isdataset(input):
+            array = input if _isdataset(input) else input[columns]
+            self._fill_chunk(fillers, lambda s: select(array, s))
+        else:
+            for array in _iterate_input(input, columns, "", treename, chunksize):
+                self._fill_chunk(fillers, lambda s: select(array, s))
+                
+        for b, filler in zip(self._bookings, fillers):
+            if filler is not None:
+                filler.write(b["hist"])
+            elif b["kind"] == "eff":
+                b["hist"].addHists(b["total"], b["passed"])
+                
+        return self.hists
+        
+    def __getitem__(self, name):
+        return self.hists[name]
         
-    hist = Hist3D(*BINS,name=name,title=name,type='F')
+
+def _tonumpy(hist):
     
-    array_to_fill = np.empty((len(array),3))
+    return hist if isinstance(hist, NumpyHist) else NumpyHist.fromhist(hist, contents=True)
     
-    array_to_fill[:,0] = array[varx]
-    array_to_fill[:,1] = array[vary]
-    array_to_fill[:,2] = array[varz]
+def AddHists(hists, name, asnumpy=False):
+    """
+    Sum of histograms with the same binning, given as a list or any iterable, e.g. a generator
+    reading them one at a time from files so that only one is in memory at a time. The contents
+    are accumulated in NumPy arrays, and the input histograms are left untouched. The sum is a
+    NumpyHist with `asnumpy` or if the inputs are NumpyHists, otherwise a histogram of the type
+    of the first one. A ValueError is raised on the first histogram with a different binning.
+    """
     
-    if weights:
-        hist.Sumw2()
-        fill_hist3d(hist,array_to_fill,array[weights])
+    hists = iter(hists)
+    try:
+        first = next(hists)
+    except StopIteration:
+        raise ValueError("No histogram to add!")
+        
+    if not isinstance(first, NumpyHist) and first.InheritsFrom("TProfile"):
+        # profiles are not plain sums of contents
+        total = first.Clone(name)
+        total.SetTitle(name)
+        for hist in hists:
+            total.Add(hist)
+        return total
+        
+    filler = _tonumpy(first).copy(name)
+    filler.title = name
+    
+    if asnumpy or isinstance(first, NumpyHist):
+        template = None
     else:
-        fill_hist3d(hist,array_to_fill)
+        template = first.Clone(name)
+        
+    for i, hist in enumerate(hists, 1):
+        other = _tonumpy(hist)
+        if not filler.compatible(other):
+            raise ValueError("Histogram {0} ({1}) has a different binning than the first one!".format(i, other.name))
+        filler += other
+        
+    if template is None:
+        return filler
+        
+    template.Reset()
+    template.SetTitle(name)
+    if template.GetSumw2N() == 0:
+        template.Sumw2()
+        
+    return filler.write(template)
+    
+def _readhist(file, histname):
+    
+    f = ROOT.TFile.Open(file)
+    hist = f.Get(histname)
+    if not hist:
+        raise ValueError("No histogram {0} in {1}!".format(histname, file))
+    hist.SetDirectory(0)
+    f.Close()
     
     return hist
     
-
-def AddHists(hists, name):
+def _addfiles(files, histname):
     
-    for hist in hists:
-        if hist == hists[0]:
-            hist.Sumw2()
-            continue
-        else:
-            hists[0].Add(hist)
-            destruct_object(hist)
+    # partial sum, as a picklable NumpyHist, of the histograms of a group of files
+    return AddHists((_readhist(f, histname) for f in files), histname, asnumpy=True)
     
-    histogram = hists[0]
-    histogram.SetNameTitle(name,name)
-    return histogram
-
+def _treereduce(hists):
+    
+    # pairwise sums, the order of the terms being kept
+    while len(hists) > 1:
+        hists = [hists[i] + hists[i+1] if i+1 < len(hists) else hists[i] for i in range(0, len(hists), 2)]
+        
+    return hists[0]
+    
+def MergeHists(files, histname, name="", nworkers=None, asnumpy=False):
+    """
+    Sum of the histogram `histname` of many ROOT files (e.g. the outputs of batch jobs), read one
+    file at a time. With `nworkers` the files are split into groups summed by as many processes,
+    whose partial sums are then added pairwise.
+    """
+    
+    files = globfiles(files)
+    name = name or histname
+    
+    if not nworkers or len(files) < 2:
+        return AddHists((_readhist(f, histname) for f in files), name, asnumpy)
+        
+    groups = [g for g in np.array_split(np.array(files, dtype=object), nworkers) if len(g) > 0]
+    with ProcessPoolExecutor(nworkers) as executor:
+        partials = list(executor.map(_addfiles, [list(g) for g in groups], [histname]*len(groups)))
+        
+    total = _treereduce(partials)
+    total.name = total.title = name
+    
+    if asnumpy:
+        return total
+        
+    template = _readhist(files[0], histname).Clone(name)
+    if template.InheritsFrom("TProfile"):
+        raise ValueError("Profiles can not be merged in parallel, merge them without nworkers!")
+    template.Reset()
+    template.SetTitle(name)
+    if template.GetSumw2N() == 0:
+        template.Sumw2()
+        
+    return total.write(template)
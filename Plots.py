@@ -9,28 +9,29 @@ ROOT = softimport("ROOT")
 import glob
 import os
 import numpy as np
+from Utilities import Stats
 probfit = softimport("probfit")
 iminuit = softimport("iminuit")
-from scipy.stats import chisquare
+scipy_stats = softimport("scipy.stats", asname="scipy_stats")
 
 import logging 
 mpl_logger = logging.getLogger('matplotlib') 
 mpl_logger.setLevel(logging.WARNING) 
 
 Hist = softimport(".Hist")
-import matplotlib as mpl
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-rootpy = softimport("rootpy.plotting.root2matplotlib")
-from future.utils import iteritems
+mpl = softimport("matplotlib", asname="mpl")
+mpatches = softimport("matplotlib.patches", asname="mpatches")
+plt = softimport("matplotlib.pyplot", asname="plt")
+gridspec = softimport("matplotlib.gridspec", asname="gridspec")
+rplt = softimport("rootpy.plotting.root2matplotlib", asname="rplt")
 
 zfit = softimport("zfit")
 tf = softimport("tensorflow")
 physt = softimport("physt")
-from uncertainties import unumpy, ufloat
+uncertainties = softimport("uncertainties")
+unumpy = softimport("uncertainties.unumpy", asname="unumpy")
 
-import mplhep
+mplhep = softimport("mplhep")
 
 def addticks(ax):
     ax.get_yaxis().set_tick_params(direction='in', left=True, right=True)
@@ -87,7 +88,7 @@ def LHCbStyle():
     STYLE['ytick.minor.pad'] =   10
     STYLE['ytick.labelsize'] =   17
     
-    for k, v in iteritems(STYLE):
+    for k, v in STYLE.items():
             mpl.rcParams[k] = v
     
 def Decorate(Objs, Filled=False, Legend=None, Normalized=False, Err=False, Candle=False, MPL=False):
@@ -207,8 +208,6 @@ def Draw(Dict, Logy=False, Err=False, minY=-999999, maxY=999999, Candle=False):
         
 def DrawMPL(Dicts, axes, Logy=False, Err=False, Legend=True, Xlabel=None, Ylabel=None, xlimit = (-999999,999999), ylimit = (-999999,999999)):
     
-    rplt = rootpy.plotting.root2matplotlib
-
     Objs = Dicts
     
     minY, maxY = ylimit[0], ylimit[1]
@@ -310,9 +309,23 @@ def plotVariables(Objs, Folder, FileName, Filled=False, Legend=None, Normalized=
         plt.close(fig)
         
         
+def _residuals(datay, pdfy, errory, residuals="pull"):
+    
+    # residuals="pull" gives (data - model) / error, residuals="deviance" the Poisson deviance
+    # residuals, as RooFit.ResidualPlot. Both are in units of standard deviations, hence their
+    # error bars are one, and zero for empty bins.
+    if residuals == "deviance":
+        pully = Stats.deviance_residuals(datay, pdfy)
+    elif residuals == "pull":
+        pully = Stats.pulls(datay, pdfy, errory)
+    else:
+        raise ValueError("Unknown residuals {0}, use pull or deviance!".format(residuals))
+        
+    return pully, np.where(np.asarray(datay) != 0, 1., 0.)
+    
 def plotFitResult( cost_function, fitresult, y_label, x_label, description={}, nbins=100, plot_residuals=True, logy=False, 
                    chi2_pos=(0.7, 0.5), show_params=False, params_loc=(0.05, 0.95), legend_pos="best", 
-                   xlimit=(-999999,999999), ylimit=(-999999,999999), **kwargs ):
+                   xlimit=(-999999,999999), ylimit=(-999999,999999), residuals="pull", **kwargs ):
                     
     values = fitresult.values
     errors = fitresult.errors
@@ -419,7 +432,7 @@ def plotFitResult( cost_function, fitresult, y_label, x_label, description={}, n
         
         ax2.axes.set_ylim((-5,5))
         ax2.axes.set_xlim((xmin, xmax))
-        ax2.axes.set_ylabel("Pulls")
+        ax2.axes.set_ylabel("Pulls" if residuals == "pull" else "Residuals")
         ax2.axes.set_xlabel(x_label, ha ='right', x=1)
         ax2.get_yaxis().set_tick_params(direction='in', left=True, right=True)
         ax2.get_xaxis().set_tick_params(direction='in', bottom=True, top=True)
@@ -430,18 +443,18 @@ def plotFitResult( cost_function, fitresult, y_label, x_label, description={}, n
         ax2.plot([xmin, xmax], [-2, -2], color = "indianred", lw=1.5, linestyle = '-.')
         ax2.minorticks_on()
         
-        if isinstance(cost_function, probfit.costfunc.BinnedLH):
-            cost_function.draw_residual(minuit=fitresult, show_errbars=True, errbar_algo='sumw2', norm=True, ax=ax2, mec='Black', mfc='Black', 
-                                        ecolor='Black', markersize=6, zero_line=False, bound=xlimit)
-        else:
-            cost_function.draw_residual(show_errbars=True, errbar_algo='sumw2', norm=True, ax=ax2, mec='Black', mfc='Black', 
-                                        ecolor='Black', markersize=6, bins=nbins, zero_line=False, bound=xlimit, args=values, errors=errors)
+        # expected counts at the bin centres, from the model curve scaled to the data by probfit
+        centres = probfit.mid(data_edges)
+        pdfy = np.interp(centres, total_pdf_x, total_pdf_y)
+        pully, pullerr = _residuals(datay, pdfy, errorp, residuals)
+        ax2.errorbar(centres, pully, yerr=pullerr, xerr=xerr, fmt='.', capsize=0, ecolor='Black', 
+                     color='Black', markersize=6)
                     
     f.align_ylabels()
     
 def plotZfitResult(pdf, data, x_label, y_label=None, description={}, nbins=100, plot_residuals=True, logy=False, 
                    chi2_pos=(0.7, 0.5), legend_pos="best", xlim=None, ylim=None, chi2=True,
-                   units="GeV/c$^{2}$", **kwargs ):
+                   units="GeV/c$^{2}$", residuals="pull", **kwargs ):
                 
     bounds = xlim if xlim else pdf.space.limit1d 
     
@@ -552,7 +565,7 @@ def plotZfitResult(pdf, data, x_label, y_label=None, description={}, nbins=100,
     
     if chi2:
         nfree_params = kwargs.get("nfree_params", len(pdf.get_dependents()))
-        chi2 = chisquare(datay, pdfy, nfree_params)[0]
+        chi2 = scipy_stats.chisquare(datay, pdfy, nfree_params)[0]
         ndof = nbins - 1 + nfree_params
         chi2ndof = chi2  / ndof 
         ax1.text(chi2_pos[0], chi2_pos[1], r'$\chi^{2}$/ndof = ' + f"{chi2ndof:.2f}", transform = ax1.transAxes )
@@ -567,17 +580,15 @@ def plotZfitResult(pdf, data, x_label, y_label=None, description={}, nbins=100,
             
         ax2.axes.set_ylim((-5,5))
         ax2.axes.set_xlim(bounds)
-        ax2.axes.set_ylabel("Pulls")
+        ax2.axes.set_ylabel("Pulls" if residuals == "pull" else "Residuals")
         ax2.axes.set_xlabel(x_label, ha ='right', x=1)
         addticks(ax2)
         ax2.plot(list(bounds), [2, 2], color = "indianred", lw=1.5, linestyle = '-.')
         ax2.plot(list(bounds), [0, 0], color = "grey", lw=1.5, linestyle = '-.')
         ax2.plot(list(bounds), [-2, -2], color = "indianred", lw=1.5, linestyle = '-.')
         ax2.minorticks_on()
-        datay = unumpy.uarray(datay, errory)
-        errory = np.where(datay == 0., np.ones(errory.shape), errory)
-        pully = (datay - pdfy) / errory
-        ax2.errorbar(bin_centers, unumpy.nominal_values(pully), yerr=unumpy.std_devs(pully), fmt='.', ecolor='Black',
+        pully, pullerr = _residuals(datay, pdfy, errory, residuals)
+        ax2.errorbar(bin_centers, pully, yerr=pullerr, fmt='.', ecolor='Black',
                      markersize=4, color='Black', elinewidth=1.5)
     else:
         ax2 = None
@@ -595,7 +606,7 @@ def plotZfitResult(pdf, data, x_label, y_label=None, description={}, nbins=100,
     
 def PullImpact(fitresult, constraints, paramdict=None):
     
-    uf = lambda p: ufloat(fitresult.params[p]["value"], fitresult.params[p]["minuit_hesse"]["error"])
+    uf = lambda p: uncertainties.ufloat(fitresult.params[p]["value"], fitresult.params[p]["minuit_hesse"]["error"])
     
     pdict = {}
     params = []
@@ -5,53 +5,63 @@
 # @date   2017-19-05
 
 from __future__ import division
-import ROOT
+from Utilities.dependencies import softimport
 import glob
 import os
+import sys
 import math
 import numpy as np
-from rootpy import asrootpy
-from rootpy.plotting import Hist
-import matplotlib.pyplot as plt
-import rootpy.plotting.root2matplotlib as rplt
-from Utilities.Plots import LHCbStyle
+rootpy = softimport("rootpy.plotting")
+plt = softimport("matplotlib.pyplot", asname="plt")
+rplt = softimport("rootpy.plotting.root2matplotlib", asname="rplt")
+root_numpy = softimport("root_numpy")
+from Utilities.Tree import iterTree
+from Utilities.Selection import compile_selection
+from Utilities.Hist import ArrayHist, BinningScheme
+from Utilities.utilities import destruct_objects
+from Utilities import Stats
 from uuid import uuid4
 from math import sqrt, log
 
 
-ROOT.RooWorkspace.rfimport = getattr(ROOT.RooWorkspace,'import')
+def _rfimport(ROOT):
+    ROOT.RooWorkspace.rfimport = getattr(ROOT.RooWorkspace,'import')
 
-# Proxies for RooFit classes
-RooFit        = ROOT.RooFit
-RooDataHist   = ROOT.RooDataHist
-RooRealVar    = ROOT.RooRealVar
-RooArgList    = ROOT.RooArgList
-RooArgSet     = ROOT.RooArgSet
-RooAbsReal    = ROOT.RooAbsReal
-RooDataSet    = ROOT.RooDataSet
-RooCBShape    = ROOT.RooCBShape
-RooAddPdf     = ROOT.RooAddPdf
-RooExtendPdf  = ROOT.RooExtendPdf
-RooPolynomial = ROOT.RooPolynomial
-RooLinearVar  = ROOT.RooLinearVar
-RooConst      = ROOT.RooFit.RooConst
-RooConstVar   = ROOT.RooConstVar
-RooChebychev  = ROOT.RooChebychev
-RooArgusBG    = ROOT.RooArgusBG
-RooExponential= ROOT.RooExponential
+# RooWorkspace.rfimport is added as soon as ROOT is loaded: right away if it is already imported,
+# otherwise when this module first uses ROOT, e.g. with `from Utilities.RooFit import *` (which
+# resolves the proxies below) or the first RooFit class used from it.
+ROOT = softimport("ROOT", onload=_rfimport)
+if "ROOT" in sys.modules:
+    _rfimport(sys.modules["ROOT"])
+
+# Proxies for RooFit classes, resolved when first used (see `__getattr__`)
+_proxies = ["RooFit", "RooDataHist", "RooRealVar", "RooArgList", "RooArgSet", "RooAbsReal",
+            "RooDataSet", "RooCBShape", "RooAddPdf", "RooExtendPdf", "RooPolynomial",
+            "RooLinearVar", "RooConstVar", "RooChebychev", "RooArgusBG", "RooExponential"]
+
+def __getattr__(name):
+    
+    if name in _proxies:
+        return getattr(ROOT, name)
+    elif name == "RooConst":
+        return ROOT.RooFit.RooConst
+    elif name == "asrootpy":
+        return rootpy.asrootpy
+    elif name == "Hist":
+        return rootpy.plotting.Hist
+        
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 class RooDataset(object):
     
     def __init__(self, Name, RooVar):
         
         self.var  = RooVar
-        self.data = RooDataSet( Name, Name, RooArgSet(self.var))
+        self.data = ROOT.RooDataSet( Name, Name, ROOT.RooArgSet(self.var))
         
     def fill(self, array):
         
-        for ai in array:
-            self.var.setVal(ai)
-            self.data.add(RooArgSet(self.var))
+        self.data.append(_bulkdataset(self.data.GetName(), [self.var], [array]))
             
     def Print(self, option):
             
@@ -82,38 +92,174 @@ def RemoveEmptyBins(frame,hist_name="0"):
             hist.SetPointEYhigh(i,0)
         
 
-def DataSet(Input,RooVar,DataSetName,Variable=None,Treename='DecayTree',Selection='',Wspace=None,Scale=1):
+def _bulkdataset(name, RooVars, columns, weights=None, weightname="weight"):
+    
+    # The RooDataSet is filled in one go from an intermediate TTree, whose branches are named
+    # after the RooRealVars, instead of adding the entries one by one. As for any import from a
+    # TTree, the entries outside of the range of a RooRealVar are not imported.
+    names = [v.GetName() for v in RooVars]
+    if weights is not None:
+        names.append(weightname)
+        columns = list(columns) + [weights]
+        
+    array = np.empty(len(columns[0]), dtype=[(n, np.float64) for n in names])
+    for n, c in zip(names, columns):
+        array[n] = c
+        
+    # the tree is created in memory, in gROOT rather than in the current directory (e.g. an
+    # output file), and deleted once the dataset is filled. The TContext makes gROOT the current
+    # directory and restores the previous one when it is deleted.
+    context = ROOT.TDirectory.TContext(ROOT.gROOT)
+    try:
+        tree = root_numpy.array2tree(array, name="tree_{0}".format(uuid4().hex))
+        tree.SetDirectory(0)
+    finally:
+        del context
+    
+    argset = ROOT.RooArgSet()
+    for v in RooVars:
+        argset.add(v)
+        
+    if weights is None:
+        dataSet = ROOT.RooDataSet(name, name, tree, argset)
+    else:
+        weightvar = ROOT.RooRealVar(weightname, weightname, -float("inf"), float("inf"))
+        argset.add(weightvar)
+        dataSet = ROOT.RooDataSet(name, name, tree, argset, "", weightname)
+        
+    destruct_objects(tree)
+    
+    return dataSet
     
+def _readcolumns(Input,RooVar,Variable,Treename,Selection,Scale,Weight):
+    
+    # values of each variable, divided by `Scale`, and weights (or None) of the selected entries
     Scale = float(1 / Scale)
     
-    if isinstance(Input,str) and (".root" in Input):
-        array = root2array(Input,Treename,Variable,Selection) * Scale
+    RooVars = list(RooVar) if isinstance(RooVar, (list, tuple)) else [RooVar]
+    if Variable is None:
+        Variable = [v.GetName() for v in RooVars]
+    Variables = list(Variable) if isinstance(Variable, (list, tuple)) else [Variable]
+    branches = Variables + ([Weight] if Weight is not None else [])
+    
+    if isinstance(Input,(list,tuple)) or (isinstance(Input,str) and (".root" in Input)) or isinstance(Input,ROOT.TTree):
+        array = next(iterTree(Input,Treename,branches,Selection))
     elif isinstance(Input,np.ndarray):
         if isinstance(Input.dtype.names,tuple):
-            array = Input[Variable] * Scale
+            array = compile_selection(Selection).apply(Input,branches)
         else:
-            array = Input * Scale
-    elif isinstance(Input,ROOT.TTree):
-        array = tree2array(Input,Variable,Selection) * Scale
+            array = {Variables[0]: Input}
+            
+    columns = [np.asarray(array[v], dtype=np.float64) * Scale for v in Variables]
+    weights = array[Weight] if Weight is not None else None
+    
+    return RooVars, columns, weights
+    
+def _towspace(Wspace, RooVars, data):
+    
+    for v in RooVars:
+        if not Wspace.allVars().contains(v):
+            "Print the RooRealVar dubbed {0} is added to the working space {1}!".format(v.GetName(),Wspace.GetName())
+            Wspace.rfimport(v)  
+            
+    Wspace.rfimport(data)
+    
+def DataSet(Input,RooVar,DataSetName,Variable=None,Treename='DecayTree',Selection='',Wspace=None,Scale=1,Weight=None,
+            Binned=False,Bins=None):
+    """
+    RooDataSet of the values of `Variable` (a branch or field name, or a list of them) for the
+    RooRealVar `RooVar` (or list of RooRealVars, one per variable) in `Input`, a ROOT file, a list
+    of files, a TTree or a NumPy array. The variables are divided by `Scale`, and with `Weight`
+    (a branch or field name) the dataset is weighted. It is imported into `Wspace` if given.
+    With `Binned` a RooDataHist with the binning `Bins` is made instead, see `DataHist`.
+    """
+    
+    if Binned:
+        return DataHist(Input,RooVar,DataSetName,Variable,Treename,Selection,Wspace,Scale,Weight,Bins)
         
-
-    dataSet = RooDataSet(DataSetName,DataSetName,RooArgSet(RooVar))
+    RooVars, columns, weights = _readcolumns(Input,RooVar,Variable,Treename,Selection,Scale,Weight)
     
-    for i in array:
-        RooVar.setVal(i)
-        dataSet.add(RooArgSet(RooVar))
+    dataSet = _bulkdataset(DataSetName, RooVars, columns, weights)
         
     dataSet.Print('v')
     
     if not Wspace == None:
-        if not Wspace.allVars().contains(RooVar):
-            "Print the RooRealVar dubbed {0} is added to the working space {1}!".format(RooVar.GetName(),Wspace.GetName())
-            Wspace.rfimport(RooVar)  
-    
-    Wspace.rfimport(dataSet)
+        _towspace(Wspace, RooVars, dataSet)
 
     return dataSet
     
+def _edges(RooVar, Bins):
+    
+    # None: binning of the RooRealVar, int: uniform bins in its range, else bin edges
+    if Bins is None:
+        Bins = RooVar.getBins()
+    if isinstance(Bins, BinningScheme):
+        return np.asarray(Bins.ReturnBins(), dtype=np.float64), False
+    if isinstance(Bins, (int, np.integer)):
+        return np.linspace(RooVar.getMin(), RooVar.getMax(), Bins + 1), True
+        
+    return np.asarray(Bins, dtype=np.float64), False
+    
+def _bulkdatahist(name, RooVars, columns, weights=None, Bins=None):
+    
+    # The entries are histogrammed with NumPy into a TH1/TH2/TH3, imported by the RooDataHist
+    # constructor together with its binning and sum of squared weights.
+    if len(RooVars) > 3:
+        raise ValueError("A RooDataHist can be built from at most 3 observables!")
+    if Bins is None or isinstance(Bins, (int, np.integer, BinningScheme)) or len(RooVars) == 1:
+        Bins = [Bins] * len(RooVars)
+        
+    edges, uniform = zip(*[_edges(v, b) for v, b in zip(RooVars, Bins)])
+    
+    filler = ArrayHist(edges, uniform)
+    filler.fill(columns, weights)
+    
+    hname = "hist_{0}".format(uuid4().hex)
+    args = []
+    for e in edges:
+        args += [len(e) - 1, e]
+    hist = getattr(ROOT, "TH{0}D".format(len(edges)))(hname, hname, *args)
+    hist.SetDirectory(0)
+    filler.write(hist)
+    
+    arglist = ROOT.RooArgList()
+    for v in RooVars:
+        arglist.add(v)
+        
+    return ROOT.RooDataHist(name, name, arglist, ROOT.RooFit.Import(hist))
+    
+def DataHist(Input,RooVar,DataHistName,Variable=None,Treename='DecayTree',Selection='',Wspace=None,Scale=1,Weight=None,Bins=None):
+    """
+    Binned equivalent of `DataSet`, with the same arguments, returning a RooDataHist. `Bins` is
+    the binning of each observable: a number of uniform bins in the range of the RooRealVar, bin
+    edges or a BinningScheme, by default the binning of the RooRealVar. With several observables
+    it is a list with one binning per RooRealVar. Weighted entries keep their sum of squared
+    weights as errors.
+    """
+    
+    RooVars, columns, weights = _readcolumns(Input,RooVar,Variable,Treename,Selection,Scale,Weight)
+    
+    dataHist = _bulkdatahist(DataHistName, RooVars, columns, weights, Bins)
+    
+    dataHist.Print('v')
+    
+    if not Wspace == None:
+        _towspace(Wspace, RooVars, dataHist)
+        
+    return dataHist
+    
+    
+def _graphpoints(graph):
+    
+    # x and y of the points of a TGraph (e.g. a RooHist or RooCurve) as NumPy arrays
+    n = graph.GetN()
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+        
+    x = np.frombuffer(graph.GetX(), dtype=np.float64, count=n).copy()
+    y = np.frombuffer(graph.GetY(), dtype=np.float64, count=n).copy()
+    
+    return x, y
     
 class ResidualPlot(object):
     def __init__(self, title, frame):
@@ -296,14 +442,6 @@ class ResidualPlot(object):
         return label
 
     def residualHist(self, data, curve, xAxis, resRange, chisum=0.0):
-        def getResidual(datum, pdf):
-            chi2 = 0.0
-            if pdf > 0:
-                chi2 += 2.0 * (pdf-datum)
-                if datum > 0:
-                    chi2 += 2.0 * datum * log(datum/pdf)
-            return sqrt(chi2) if datum > pdf else -sqrt(chi2)
-
         # Proportion correction
         #r = 0.2
         #sr = 1.0/0.2
@@ -316,26 +454,26 @@ class ResidualPlot(object):
         # Create residual histo
         residuals = ROOT.TH1F("residuals_{0}".format(self._id), "", n, xMin, xMax)
         pulls     = ROOT.TH1F("pulls_{0}".format(self._id), "", 11, -5.5, 5.5)
-        datum = ROOT.Double(0.0)
-        pdf     = 0.0
-        xBin    = ROOT.Double(0.0)
-        resValue = ROOT.Double(0.0)
         # ranges
         rangeMin, rangeMax = resRange
         if curve:
-            for bin in range(n):
-                data.GetPoint(bin, xBin, datum)
-                if xBin < rangeMin or xBin > rangeMax:
-                    continue
-                pdf = curve.Eval(xBin)
-                resValue = getResidual(datum, pdf)
-                chisum += resValue*resValue
-                #print datum, pdf
-                #print "chisum:", chisum
-                #print "Setting bin: ", bin+1, resValue
-                residuals.SetBinContent(bin+1, resValue)
-                residuals.SetBinError(bin+1, 1.0)
-                pulls.Fill(resValue)
+            xBin, datum = _graphpoints(data)
+            inrange = (xBin >= rangeMin) & (xBin <= rangeMax)
+            # the curve is linearly interpolated between its points, as RooCurve::Eval
+            curveX, curveY = _graphpoints(curve)
+            pdf = np.interp(xBin, curveX, curveY)
+            resValue = np.where(inrange, Stats.deviance_residuals(datum, pdf), 0.)
+            chisum += float(np.sum(resValue**2))
+            # bins 0 and n+1 are the under- and overflow
+            content = np.zeros(n+2)
+            content[1:n+1] = resValue
+            errors = np.zeros(n+2)
+            errors[1:n+1] = np.where(inrange, 1.0, 0.)
+            residuals.SetContent(content)
+            residuals.SetError(errors)
+            inrangeValues = np.ascontiguousarray(resValue[inrange])
+            if len(inrangeValues) > 0:
+                pulls.FillN(len(inrangeValues), inrangeValues, np.ones(len(inrangeValues)))
         # Cosmetics
         residuals.SetMinimum        ( -5.     )
         residuals.SetMaximum        (    5.     )
@@ -390,6 +528,8 @@ class ResidualPlot(object):
         histo = self._frame.getHist(histo_name)
         self._frame.SetYTitle(histo.getYAxisLabel().replace('Events', 'Candidates'))
 
+# `from Utilities.RooFit import *` exports the public names of the module and the proxies
+__all__ = [n for n in list(globals()) if not n.startswith("_")] + _proxies + ["RooConst", "asrootpy", "Hist"]
 
 # EOF
 
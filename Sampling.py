@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# @file   Sampling.py
+# @author Matthieu Marinangeli (matthieu.marinangeli@epfl.ch)
+# @date   2020-03-16
+
+from __future__ import division
+import numpy as np
+
+# Reproducible subsampling of streams of structured arrays (e.g. the chunks yielded by
+# Tree.iterTree), and deterministic splitting of entries into folds.
+
+def _randomstate(seed, stream):
+    
+    # each sampling draws from its own stream for a given seed, such that e.g. a Bernoulli
+    # subsample followed by a reservoir sample are not correlated
+    return np.random.RandomState(None if seed is None else [seed, stream])
+    
+def bernoulli(chunks, fraction, seed=None):
+    """
+    Keep each entry with probability `fraction`. The random numbers are drawn sequentially,
+    so for a given `seed` the sample does not depend on how the entries are chunked.
+    """
+
+    rng = _randomstate(seed, 0)
+
+    for chunk in chunks:
+        yield chunk[rng.random_sample(len(chunk)) < fraction]
+
+def reservoir(chunks, size, seed=None):
+    """
+    Sample exactly `size` entries (or all of them if there are fewer) without replacement,
+    keeping at most `size` entries plus one chunk in memory. The entries of the sample are
+    yielded as a single array, in their original order.
+    """
+
+    rng = _randomstate(seed, 1)
+    sample, keys, index = None, None, None
+    offset = 0
+
+    for chunk in chunks:
+        # the entries with the `size` smallest random keys form a uniform sample
+        k = rng.random_sample(len(chunk))
+        i = np.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+
+        if sample is None:
+            sample, keys, index = chunk, k, i
+        else:
+            sample = np.concatenate([sample, chunk])
+            keys = np.concatenate([keys, k])
+            index = np.concatenate([index, i])
+
+        if len(keys) > size:
+            keep = np.argpartition(keys, size)[:size]
+            sample, keys, index = sample[keep], keys[keep], index[keep]
+
+    if sample is not None:
+        yield sample[np.argsort(index)]
+
+def _asuint64(values):
+
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return values.astype(np.float64).view(np.uint64)
+    else:
+        return values.astype(np.int64).view(np.uint64)
+
+def _mix(x):
+
+    # splitmix64 finalizer, the arithmetic wraps around modulo 2**64
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def fold(array, nfolds, branches=("runNumber", "eventNumber")):
+    """
+    Fold, between 0 and `nfolds` - 1, of each entry. It is a hash of the values of `branches`,
+    so an event always falls into the same fold, whatever the files, order or selection.
+    """
+
+    h = np.zeros(len(array), dtype=np.uint64)
+    for b in branches:
+        h = _mix(h ^ _asuint64(array[b]))
+
+    return (h % np.uint64(nfolds)).astype(np.int64)
+
+def select_folds(chunks, nfolds, folds, branches=("runNumber", "eventNumber")):
+    """Keep the entries in `folds` (a fold number or a list of them) out of `nfolds` folds."""
+
+    folds = np.atleast_1d(folds)
+
+    for chunk in chunks:
+        yield chunk[np.isin(fold(chunk, nfolds, branches), folds)]
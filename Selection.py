@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# @file   Selection.py
+# @author Matthieu Marinangeli (matthieu.marinangeli@epfl.ch)
+# @date   2020-03-02
+
+from __future__ import division
+import re
+import numpy as np
+
+# Compiler of ROOT TCut-style selection strings, e.g. "B_PT > 1000 && abs(B_ETA - 3) < 1",
+# into vectorized NumPy predicates. The compiled selections are cached by expression string.
+
+_token = re.compile(r"""
+    \s*(?:
+      (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_.]*(?:::[A-Za-z_][A-Za-z0-9_]*)*)
+    | (?P<op>&&|\|\||==|!=|<=|>=|[-+*/%<>!&|^(),\[\]])
+    )""", re.VERBOSE)
+
+_binary = {
+    "||": (1, "np.logical_or({0}, {1})"),
+    "&&": (2, "np.logical_and({0}, {1})"),
+    "|":  (3, "np.bitwise_or({0}, {1})"),
+    "^":  (4, "np.bitwise_xor({0}, {1})"),
+    "&":  (5, "np.bitwise_and({0}, {1})"),
+    "==": (6, "({0} == {1})"),
+    "!=": (6, "({0} != {1})"),
+    "<":  (7, "({0} < {1})"),
+    "<=": (7, "({0} <= {1})"),
+    ">":  (7, "({0} > {1})"),
+    ">=": (7, "({0} >= {1})"),
+    "+":  (8, "({0} + {1})"),
+    "-":  (8, "({0} - {1})"),
+    "*":  (9, "({0} * {1})"),
+    "/":  (9, "({0} / {1})"),
+    "%":  (9, "np.fmod({0}, {1})"),
+}
+
+_unary = {
+    "!": "np.logical_not({0})",
+    "-": "(-{0})",
+    "+": "(+{0})",
+}
+
+_functions = {
+    "abs": "np.abs", "fabs": "np.abs", "TMath::Abs": "np.abs",
+    "sqrt": "np.sqrt", "TMath::Sqrt": "np.sqrt",
+    "exp": "np.exp", "TMath::Exp": "np.exp",
+    "log": "np.log", "TMath::Log": "np.log",
+    "log10": "np.log10", "TMath::Log10": "np.log10",
+    "pow": "np.power", "TMath::Power": "np.power",
+    "sin": "np.sin", "cos": "np.cos", "tan": "np.tan",
+    "asin": "np.arcsin", "acos": "np.arccos", "atan": "np.arctan",
+    "TMath::Sin": "np.sin", "TMath::Cos": "np.cos", "TMath::Tan": "np.tan",
+    "TMath::ASin": "np.arcsin", "TMath::ACos": "np.arccos", "TMath::ATan": "np.arctan",
+    "atan2": "np.arctan2", "TMath::ATan2": "np.arctan2",
+    "sinh": "np.sinh", "cosh": "np.cosh", "tanh": "np.tanh",
+    "min": "np.minimum", "max": "np.maximum", "TMath::Min": "np.minimum", "TMath::Max": "np.maximum",
+    "floor": "np.floor", "ceil": "np.ceil", "TMath::Floor": "np.floor", "TMath::Ceil": "np.ceil",
+    "TMath::Pi": "(lambda: np.pi)",
+}
+
+_constants = {"true": "True", "false": "False", "kTRUE": "True", "kFALSE": "False"}
+
+
+def _tokenize(expression):
+
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+
+    while pos < len(expression):
+        match = _token.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise ValueError("Can not parse selection {0!r} at position {1}!".format(expression, pos))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+
+    return tokens
+
+
+class _Parser(object):
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.branches = []
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise ValueError("Expected {0!r} in selection {1!r}!".format(value, self.expression))
+
+    def parse(self):
+        source = self.expr(0)
+        if self.pos != len(self.tokens):
+            raise ValueError("Unexpected {0!r} in selection {1!r}!".format(self.peek()[1], self.expression))
+        return source
+
+    def expr(self, precedence):
+
+        left = self.unary()
+
+        while True:
+            kind, token = self.peek()
+            if kind != "op" or token not in _binary or _binary[token][0] <= precedence:
+                return left
+            self.next()
+            prec, template = _binary[token]
+            left = template.format(left, self.expr(prec))
+
+    def unary(self):
+
+        kind, token = self.peek()
+        if kind == "op" and token in _unary:
+            self.next()
+            return _unary[token].format(self.unary())
+        return self.atom()
+
+    def atom(self):
+
+        kind, token = self.next()
+
+        if kind == "number":
+            return token
+        elif kind == "op" and token == "(":
+            source = self.expr(0)
+            self.expect(")")
+            return source
+        elif kind == "name":
+            if self.peek()[1] == "(":
+                return self.call(token)
+            if token in _constants:
+                return _constants[token]
+            if token not in self.branches:
+                self.branches.append(token)
+            source = "_b[{0!r}]".format(token)
+            while self.peek()[1] == "[":
+                self.next()
+                source = "{0}[:, {1}]".format(source, self.expr(0))
+                self.expect("]")
+            return source
+        elif kind is None:
+            raise ValueError("Unexpected end of selection {0!r}!".format(self.expression))
+        else:
+            raise ValueError("Unexpected {0!r} in selection {1!r}!".format(token, self.expression))
+
+    def call(self, name):
+
+        if name not in _functions:
+            raise ValueError("Unknown function {0} in selection {1!r}!".format(name, self.expression))
+
+        self.expect("(")
+        args = []
+        if self.peek()[1] != ")":
+            args.append(self.expr(0))
+            while self.peek()[1] == ",":
+                self.next()
+                args.append(self.expr(0))
+        self.expect(")")
+
+        return "{0}({1})".format(_functions[name], ", ".join(args))
+
+
+class Selection(object):
+    """
+    A TCut-style expression compiled into a NumPy predicate. `branches` lists the branches the
+    expression needs. Arrays are accessed by branch name, so structured arrays, dictionaries of
+    arrays and datasets with column access can all be selected.
+    """
+
+    def __init__(self, expression=""):
+
+        self.expression = expression.strip()
+
+        if self.expression:
+            parser = _Parser(self.expression)
+            self.source = parser.parse()
+            self.branches = parser.branches
+            self._code = compile(self.source, "<selection {0!r}>".format(self.expression), "eval")
+        else:
+            self.source = "True"
+            self.branches = []
+            self._code = None
+
+    def __bool__(self):
+        return self._code is not None
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "Selection({0!r})".format(self.expression)
+
+    def evaluate(self, arrays):
+        """Value of the expression for each entry."""
+        return eval(self._code, {"np": np, "_b": arrays})
+
+    def mask(self, arrays):
+        """Boolean array of the entries passing the selection (non-zero values, as in ROOT)."""
+
+        n = len(arrays[self.branches[0]]) if self.branches else len(arrays)
+
+        if not self:
+            return np.ones(n, dtype=bool)
+
+        value = np.asarray(self.evaluate(arrays))
+        return np.broadcast_to(value != 0, (n,))
+
+    def count(self, arrays):
+        return int(np.count_nonzero(self.mask(arrays)))
+
+    def columns(self, branches):
+        """Branches to read to apply the selection after reading `branches` (None means all)."""
+
+        if branches is None:
+            return None
+        if isinstance(branches, str):
+            branches = [branches]
+
+        return list(branches) + [b for b in self.branches if b not in branches]
+
+    def apply(self, array, branches=None):
+        """Select the entries of a structured array and keep only `branches`."""
+
+        if self:
+            array = array[self.mask(array)]
+        if branches is None:
+            return array
+
+        return array[branches]
+
+
+_cache = {}
+
+def compile_selection(expression):
+    """Compiled `Selection` of an expression, cached by expression string."""
+
+    if isinstance(expression, Selection):
+        return expression
+
+    try:
+        return _cache[expression]
+    except KeyError:
+        selection = _cache[expression] = Selection(expression)
+        return selection
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# @file   Stats.py
+# @author Matthieu Marinangeli (matthieu.marinangeli@epfl.ch)
+# @date   2020-03-09
+
+from __future__ import division
+from .dependencies import softimport
+import numpy as np
+scipy_stats = softimport("scipy.stats", asname="scipy_stats")
+
+# Vectorized efficiencies and their uncertainties. All functions accept scalars or arrays
+# (e.g. the bins of histograms) of passed and total counts.
+
+ONE_SIGMA = 0.682689492137
+
+def efficiency(passed, total):
+
+    passed = np.asarray(passed, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, passed / np.where(total > 0, total, 1.), 0.)
+
+def binomial_error(passed, total):
+    """Normal approximation of the binomial uncertainty, sqrt(eff (1 - eff) / total)."""
+
+    eff = efficiency(passed, total)
+    total = np.asarray(total, dtype=np.float64)
+
+    return np.sqrt(eff * (1. - eff) / np.where(total > 0, total, 1.))
+
+def clopper_pearson(passed, total, cl=ONE_SIGMA):
+    """Central Clopper-Pearson interval (low, high) of the efficiency."""
+
+    passed = np.asarray(passed, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    alpha = (1. - cl) / 2.
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        low = np.where(passed > 0, scipy_stats.beta.ppf(alpha, passed, total - passed + 1), 0.)
+        high = np.where(passed < total, scipy_stats.beta.ppf(1. - alpha, passed + 1, total - passed), 1.)
+
+    return np.nan_to_num(low), np.where(total > 0, np.nan_to_num(high), 1.)
+
+def wilson(passed, total, cl=ONE_SIGMA):
+    """Wilson score interval (low, high) of the efficiency."""
+
+    passed = np.asarray(passed, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    z = scipy_stats.norm.ppf(0.5 + cl / 2.)
+
+    n = np.where(total > 0, total, 1.)
+    eff = passed / n
+    denominator = 1. + z**2 / n
+    centre = (eff + z**2 / (2.*n)) / denominator
+    halfwidth = z * np.sqrt(np.maximum(eff * (1. - eff) / n + z**2 / (4.*n**2), 0.)) / denominator
+
+    low = np.where(total > 0, np.clip(centre - halfwidth, 0., 1.), 0.)
+    high = np.where(total > 0, np.clip(centre + halfwidth, 0., 1.), 1.)
+
+    return low, high
+
+def bayesian(passed, total, cl=ONE_SIGMA, alpha=1., beta=1.):
+    """
+    Central interval (low, high) of the posterior Beta(passed + alpha, total - passed + beta) of
+    the efficiency, by default with a uniform prior.
+    """
+
+    passed = np.asarray(passed, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    tail = (1. - cl) / 2.
+
+    a, b = passed + alpha, total - passed + beta
+    low = scipy_stats.beta.ppf(tail, a, b)
+    high = scipy_stats.beta.ppf(1. - tail, a, b)
+
+    return np.nan_to_num(low), np.nan_to_num(high, nan=1.)
+
+def interval(passed, total, method="clopper_pearson", cl=ONE_SIGMA):
+    """Interval (low, high) of the efficiency with `method`: clopper_pearson, wilson, bayesian or normal."""
+
+    if method == "clopper_pearson":
+        return clopper_pearson(passed, total, cl)
+    elif method == "wilson":
+        return wilson(passed, total, cl)
+    elif method == "bayesian":
+        return bayesian(passed, total, cl)
+    elif method == "normal":
+        eff = efficiency(passed, total)
+        error = binomial_error(passed, total) * scipy_stats.norm.ppf(0.5 + cl / 2.)
+        return np.clip(eff - error, 0., 1.), np.clip(eff + error, 0., 1.)
+    else:
+        raise ValueError("Unknown interval method {0}!".format(method))
+
+def weighted_error(sumw_passed, sumw_total, sumw2_passed, sumw2_total):
+    """
+    Uncertainty of a weighted efficiency, where the passed events are a subset of the total ones,
+    from the sums of weights and of squared weights.
+    """
+
+    eff = efficiency(sumw_passed, sumw_total)
+    sumw_total = np.asarray(sumw_total, dtype=np.float64)
+
+    var = ((1. - 2.*eff) * np.asarray(sumw2_passed) + eff**2 * np.asarray(sumw2_total))
+    var = var / np.where(sumw_total != 0, sumw_total, 1.)**2
+
+    return np.sqrt(np.maximum(var, 0.))
+
+def deviance_residuals(observed, expected):
+    """
+    Signed Poisson deviance residuals of observed counts with respect to expected ones, whose
+    squares sum to the likelihood-ratio chi2. Bins with no expectation have a zero residual.
+    """
+
+    observed = np.asarray(observed, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logterm = np.where(observed > 0, observed * np.log(observed / expected), 0.)
+        chi2 = np.where(expected > 0, 2. * (expected - observed) + 2. * logterm, 0.)
+
+    residuals = np.sqrt(np.maximum(chi2, 0.))
+    return np.where(observed > expected, residuals, -residuals)
+
+def pulls(observed, expected, errors):
+    """(observed - expected) / errors, the bins with a zero error having an error of one."""
+
+    errors = np.asarray(errors, dtype=np.float64)
+    errors = np.where(errors > 0, errors, 1.)
+
+    return (np.asarray(observed, dtype=np.float64) - expected) / errors
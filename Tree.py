@@ -5,92 +5,277 @@
 
 from __future__ import division
 from .dependencies import softimport
-import ROOT
+ROOT = softimport("ROOT")
 import glob
 import os
 import math
+import json
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .Selection import compile_selection
+from . import Stats
+from . import Sampling
+from .utilities import ColumnTable, destruct_objects
+from . import BranchCache
 root_numpy = softimport("root_numpy")
+uproot = softimport("uproot")
+
+# I/O backend: "root" (ROOT and root_numpy) or "uproot", which needs neither. It is set with
+# `set_backend` or the UTILITIES_TREE_BACKEND environment variable.
+_io = {"backend": os.environ.get("UTILITIES_TREE_BACKEND", "root").lower(), "executor": None}
+
+def set_backend(name, decompression_executor=None):
+    """
+    Select the I/O backend of readTree, iterTree, mergefiles, tchain and Efficiency. With uproot
+    the baskets can be decompressed in parallel by `decompression_executor`, e.g. a
+    concurrent.futures.ThreadPoolExecutor. TTree objects are always read with ROOT.
+    """
+    
+    name = name.lower()
+    if name not in ("root", "uproot"):
+        raise ValueError("Unknown backend {0}! Available backends: root, uproot".format(name))
+        
+    _io["backend"] = name
+    _io["executor"] = decompression_executor
+    
+def get_backend():
+    return _io["backend"]
+    
+def _isuproot():
+    return _io["backend"] == "uproot"
+    
+def _uproot_arrays(file, treename, branches=None, start=None, stop=None):
+    
+    if isinstance(branches, str):
+        branches = [branches]
+        
+    with uproot.open(file) as f:
+        tree = f[treename]
+        names = list(branches) if branches is not None else tree.keys(recursive=False)
+        # exact names, as strings would be glob patterns (e.g. for names with * or [)
+        wanted = set(names)
+        arrays = tree.arrays(filter_name=lambda name: name in wanted, entry_start=start, entry_stop=stop,
+                             library="np", decompression_executor=_io["executor"])
+        
+    return ColumnTable(arrays)[names].toarray()
+    
+def _uproot_read(files, treename, branches, selection, start=None, stop=None):
+    
+    if selection:
+        raise ValueError("Selection {0!r} can not be evaluated without ROOT!".format(selection))
+        
+    return np.concatenate([_uproot_arrays(f, treename, branches, start, stop) for f in globfiles(files)])
+    
+def _requireroot(what):
+    
+    # the parts without an uproot equivalent fail early, rather than deep inside ROOT calls
+    try:
+        ROOT.TTree, root_numpy.tree2array
+    except ImportError as err:
+        raise ImportError("{0} needs ROOT and root_numpy, with any backend ({1})".format(what, err))
+        
+def _uproot_compression(compression):
+    
+    if isinstance(compression, int):
+        algorithm = dict((v, k) for k, v in _algorithms.items())[compression // 100]
+        compression = (algorithm, compression % 100)
+    elif isinstance(compression, str):
+        compression = (compression, 4)
+        
+    algorithm, level = compression
+    return getattr(uproot, algorithm.upper())(level)
+    
+def _uproot_writetree(chunks, fileoutput, treename, compression=None, nevents=None):
+    
+    kwargs = {} if compression is None else {"compression": _uproot_compression(compression)}
+    n = 0
+    
+    with uproot.recreate(fileoutput, **kwargs) as f:
+        tree = None
+        for chunk in chunks:
+            arrays = dict((b, np.ascontiguousarray(chunk[b])) for b in chunk.dtype.names)
+            if tree is None:
+                f[treename] = arrays
+                tree = f[treename]
+            else:
+                tree.extend(arrays)
+            n += len(chunk)
+            
+        if nevents is not None:
+            f["nevents"] = {"nevents": np.array([nevents], dtype=np.float64)}
+            
+    return n
+
+_cachedir = BranchCache.cachedir
+
+def _filekey(path):
+    
+    # files which can not be stat'ed (e.g. root:// urls) are not cached
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+        
+    return "{0}:{1}:{2}".format(os.path.abspath(path), st.st_mtime, st.st_size)
+    
+def _readcounts(path, treename, neventspath=""):
+    
+    if _isuproot():
+        with uproot.open(path) as f:
+            entries = f[treename].num_entries
+            nevents = f[neventspath]["nevents"].array(library="np")[0] if neventspath != "" else None
+        return entries, nevents
+        
+    _f = ROOT.TFile.Open(path, "READ")
+    
+    entries = _f.Get(treename).GetEntries()
+    
+    if neventspath != "":
+        nev = _f.Get(neventspath)
+        nev.GetEntry(0)
+        nevents = nev.GetLeaf("nevents").GetValue()
+    else:
+        nevents = None
+        
+    _f.Close()
+    
+    return entries, nevents
+    
+def filecounts(files, treename, neventspath="", nworkers=None):
+    """
+    Number of entries of the tree `treename`, and the number of events stored in the `nevents`
+    leaf of the tree `neventspath` if given, of each file. The files not yet known are read
+    concurrently by `nworkers` processes, and the results are cached on disk (in $UTILITIES_CACHE,
+    by default ~/.cache/Utilities) keyed by path, modification time and size.
+    """
+    
+    cachefile = os.path.join(_cachedir(), "filecounts.json")
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+        
+    ekey, nkey = "entries:" + treename, "nevents:" + neventspath
+    
+    keys = [_filekey(f) for f in files]
+    missing = [i for i, k in enumerate(keys) if k is None or ekey not in cache.get(k, {}) 
+               or (neventspath != "" and nkey not in cache.get(k, {}))]
+    
+    if nworkers and len(missing) > 1:
+        with ProcessPoolExecutor(nworkers) as executor:
+            counts = list(executor.map(_readcounts, [files[i] for i in missing], 
+                                       [treename]*len(missing), [neventspath]*len(missing)))
+    else:
+        counts = [_readcounts(files[i], treename, neventspath) for i in missing]
+        
+    results = [None] * len(files)
+    for i, (entries, nevents) in zip(missing, counts):
+        results[i] = (entries, nevents)
+        if keys[i] is not None:
+            cache.setdefault(keys[i], {})[ekey] = entries
+            if neventspath != "":
+                cache[keys[i]][nkey] = nevents
+                
+    for i, k in enumerate(keys):
+        if results[i] is None:
+            results[i] = (cache[k][ekey], cache[k].get(nkey))
+            
+    if missing:
+        if not os.path.isdir(_cachedir()):
+            os.makedirs(_cachedir())
+        tmp = "{0}.{1}".format(cachefile, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, cachefile)
+        
+    return results
 
 class tchain(object):
     
-    def __init__(self, name, files = [], nevents = ""):
+    def __init__(self, name, files = [], nevents = "", nworkers = None):
         
         self.name  = name
-        self.chain = ROOT.TChain(name)
+        self._chain = None
+        self.files = []
+        self._nentries = 0
+        self._nworkers = nworkers
         if nevents != "":
             self.__nevents = True
             self._neventspath = nevents
             self._nevents = 0
         else:
             self.__nevents = False
+            self._neventspath = ""
             
-        if not isinstance(files, list):
-            files = [files]
+        self._count(globfiles(files))
         
-        for f in files:
-            self.chain.Add(f)
-            
+    def _count(self, files):
+        
+        for entries, nevents in filecounts(files, self.name, self._neventspath, self._nworkers):
+            self._nentries += entries
             if self.__nevents:
-                self.neventsfile( f )
+                self._nevents += nevents
+                
+        self.files += files
             
+    @property
+    def chain(self):
+        """The TChain of the files, only made when used so that ROOT is not needed otherwise."""
+        
+        if self._chain is None:
+            self._chain = ROOT.TChain(self.name)
+            for f in self.files:
+                self._chain.Add(f)
+                
+        return self._chain
+        
     @property
     def nentries(self):
-        return self.chain.GetEntries()
+        return self._nentries
         
     @property
     def nevents(self):
         if self.__nevents:
             return self._nevents
         else:
-            return self.chain.GetEntries()
+            return self.nentries
             
     def select(self, selection=""):
         
-        new_tree = self.chain.CopyTree(selection)
-        
-        return ttree(new_tree)
+        _requireroot("tchain.select")
+        return tview(self.chain, selection)
     
     def neventsfile(self, _file):
-        _f = ROOT.TFile( _file, "READ" )
-        nev = _f.Get(self._neventspath)
-        
-        nev.GetEntry(0)
-        self._nevents += nev.GetLeaf("nevents").GetValue()
         
-        _f.Close()
+        _, nevents = filecounts([_file], self.name, self._neventspath)[0]
+        self._nevents += nevents
         
     def __len__(self):
         return self.nentries
             
     def addfile(self, _file):
         
-        self.chain.Add(_file)
+        files = globfiles(_file)
+        if self._chain is not None:
+            for f in files:
+                self._chain.Add(f)
+        self._count(files)
         
-        if self.__nevents:
-            self.neventsfile( _file )
-        
-        
-    def tofile(self, filename, treename = ""):
         
-        f = ROOT.TFile.Open(filename, "recreate")
+    def tofile(self, filename, treename = "", branches=None, selection="", compression=None, chunksize=1000000, nworkers=None):
+        """
+        Write the chain, or only `branches` of the entries passing `selection`, into `filename`,
+        streaming the entries chunk by chunk (see `mergefiles` for `compression` and `nworkers`).
+        """
         
-        chain = self.chain.CopyTree("")
-                
-        if treename != "":
-            chain.SetName(treename)
-            
-        if self.__nevents:
-            nevents = ROOT.TTree("nevents", "nevents")
-            nevents.SetEntries(1)
-            a_nevents  = np.zeros(1,dtype=np.float64)
-            br_nevents = nevents.Branch( 'nevents', a_nevents, 'nevents/D')
-            nevents.GetEntry(0)
-            a_nevents[0] = self._nevents
-            br_nevents.Fill()
+        if treename == "":
+            treename = self.name.split("/")[-1]
             
-        f.Write()
-        f.Close()
+        nevents = self._nevents if self.__nevents else None
+        chunks = _readchunks(self.files, self.name, branches, selection, chunksize, nworkers)
+        
+        _writetree(chunks, filename, treename, compression, nevents)
         
         print("TChain {0} written into {1}".format( self.name, filename ))
         
@@ -128,35 +313,420 @@ class ttree(object):
         
 
 
-def readTree(file,selection='',treename='DecayTree',fraction=1,branches=None):
+class tview(object):
+    """
+    Lazy view of the entries of a TTree or TChain passing a selection, used instead of copying
+    them with CopyTree. The selection is evaluated on first use, reading only the branches it
+    needs in chunks, and the passing entries are kept as an array of entry numbers.
+    """
     
-    tree_array = root_numpy.root2array(file,treename,branches,selection)
+    def __init__(self, tree, selection="", chunksize=1000000):
+        
+        _requireroot("tview")
+        self._tree = tree
+        self.selection = selection
+        self.chunksize = chunksize
+        self._entries = None
+        self._copy = None
+        
+    @property
+    def entries(self):
+        """Entry numbers, in the tree, of the selected entries."""
+        
+        if self._entries is None:
+            cut = _compile(self.selection)
+            n = self._tree.GetEntries()
+            
+            if cut is not None and not cut:
+                self._entries = np.arange(n)
+                return self._entries
+                
+            entries = []
+            for a, b in _ranges(n, self.chunksize):
+                if cut is None:
+                    # evaluated by TTreeFormula as an expression branch
+                    expr = "({0})".format(self.selection)
+                    mask = root_numpy.tree2array(self._tree, [expr], start=a, stop=b)[expr] != 0
+                elif cut.branches:
+                    mask = cut.mask(root_numpy.tree2array(self._tree, cut.branches, start=a, stop=b))
+                else:
+                    mask = np.broadcast_to(np.asarray(cut.evaluate({})) != 0, (b - a,))
+                entries.append(np.nonzero(mask)[0] + a)
+                
+            self._entries = np.concatenate(entries) if entries else np.zeros(0, dtype=np.int64)
             
-    if not fraction == 1:
-        nEvts = int(len(tree_array)*fraction)
-        tree_array = np.random.choice(tree_array,nEvts)
+        return self._entries
         
-    return root_numpy.array2tree(tree_array,name=treename)
+    @property
+    def nentries(self):
+        return len(self.entries)
+        
+    def __len__(self):
+        return self.nentries
+        
+    def arrays(self, branches=None):
+        """Structured array of `branches` for the selected entries, read chunk by chunk."""
+        
+        entries = self.entries
+        arrays = []
+        
+        for a, b in _ranges(self._tree.GetEntries(), self.chunksize):
+            local = entries[(entries >= a) & (entries < b)] - a
+            if len(local) > 0:
+                arrays.append(root_numpy.tree2array(self._tree, branches, start=a, stop=b)[local])
+                
+        if not arrays:
+            return root_numpy.tree2array(self._tree, branches, start=0, stop=0)
+            
+        return np.concatenate(arrays)
+        
+    def entrylist(self):
+        """TEntryList of the selected entries."""
+        
+        name = "elist_{0}".format(id(self))
+        self._tree.Draw(">>" + name, self.selection, "entrylist goff")
+        
+        # the list is made in the current directory, from which it is removed
+        elist = ROOT.gDirectory.Get(name)
+        elist.SetDirectory(0)
+        
+        return elist
+        
+    def _copytree(self, elist):
+        
+        # the copy is made in the current directory, and the entry list is deleted
+        self._tree.SetEntryList(elist)
+        tree = self._tree.CopyTree("")
+        self._tree.SetEntryList(0)
+        destruct_objects(elist)
+        
+        return tree
+        
+    @property
+    def tree(self):
+        """Copy of the selected entries, as returned by CopyTree (only made when used)."""
+        
+        if self._copy is None:
+            self._copy = self._copytree(self.entrylist())
+            
+        return self._copy
+        
+    def tofile(self, filename, treename = ""):
+        
+        elist = self.entrylist()
+        f = ROOT.TFile(filename, "recreate")
+        
+        tree = self._copytree(elist)
+        
+        if treename != "":
+            tree.SetName(treename)
+            
+        f.Write()
+        f.Close()
+        
+        print("TTree written into {0}".format( filename ))
+        
+        
+def nentries(file, treename='DecayTree'):
+    
+    if _isuproot():
+        with uproot.open(file) as f:
+            return f[treename].num_entries
+            
+    f = ROOT.TFile.Open(file)
+    n = f.Get(treename).GetEntries()
+    f.Close()
+    
+    return n
+    
+def globfiles(files):
+    
+    if not isinstance(files, (list,tuple)):
+        files = [files]
+        
+    expanded = []
+    for pattern in files:
+        # remote (e.g. root://) paths are not expanded by glob
+        expanded += sorted(glob.glob(pattern)) or [pattern]
+        
+    return expanded
+    
+def _ranges(nentries, chunksize, start=None, stop=None):
+    
+    start = 0 if start is None else start
+    stop = nentries if stop is None else min(stop, nentries)
     
-def mergefiles(files,treename,fileoutput,selection='',fraction=1.0,branches=None):
+    if chunksize is None:
+        yield start, stop
+    else:
+        for a in range(start, stop, chunksize):
+            yield a, min(a+chunksize, stop)
     
-    chain = ROOT.TChain(files)
+def _compile(selection):
     
-    tree_array = root_numpy.root2array(files,treename,branches,selection)
+    # selections using ROOT-only features (e.g. Sum$, aliases) are left to TTreeFormula
+    try:
+        return compile_selection(selection)
+    except ValueError:
+        return None
+    
+# number of entries read at once when fetching the entries passing a compiled selection
+_selectchunk = 100000
 
-    if not fraction == 1.0:
-        nEvts = int(len(tree_array)*fraction)
-        tree_array = np.random.choice(tree_array,nEvts)
+def _read(read, branches, selection, start=None, stop=None, pushdown=False, cached=False):
+    
+    # with `pushdown` the selection is evaluated by ROOT while reading. Otherwise the branches of
+    # the compiled selection are read first, then the other branches only for the ranges of
+    # entries with passing ones, so the rejected entries are never held in memory. With the
+    # branch `cached` all the columns of the range are read at once, such that a read of whole
+    # files stores them in the cache (and later memory-maps them).
+    cut = None if pushdown else _compile(selection)
+    
+    if cut is None:
+        return read(branches, selection, start=start, stop=stop)
+    if cached or not cut.branches:
+        return cut.apply(read(cut.columns(branches), "", start=start, stop=stop), branches)
         
-    print(len(tree_array))
+    mask = cut.mask(read(cut.branches, "", start=start, stop=stop))
+    first = 0 if start is None else start
     
-    root_numpy.array2root(tree_array,fileoutput,'DecayTree','recreate')
+    arrays = []
+    for a in range(0, len(mask), _selectchunk):
+        m = mask[a:a+_selectchunk]
+        if m.any():
+            arrays.append(read(branches, "", start=first+a, stop=first+a+len(m))[m])
+            
+    if not arrays:
+        return read(branches, "", start=first, stop=first)
+        
+    return np.concatenate(arrays)
+    
+# branches identifying an event, from which the folds are computed
+_foldby = ("runNumber", "eventNumber")
 
-def Efficiency(tree_total,selection=''):
+def _cachedread(read):
     
-    number_total = tree_total.GetEntries()
-    tree_passed = tree_total.CopyTree(selection)
-    number_passed = tree_passed.GetEntries()
+    # the branches of files are read through the branch cache when it is enabled and the
+    # selection, if any, is applied by the compiled selection
+    def cachedread(files, treename, branches, selection, start=None, stop=None):
+        
+        if not BranchCache.enabled() or selection or branches is None:
+            return read(files, treename, branches, selection, start=start, stop=stop)
+        if isinstance(branches, str):
+            branches = [branches]
+            
+        return np.concatenate([BranchCache.read(f, treename, branches, lambda br, **kw: read(f, treename, br, "", **kw), start, stop) 
+                               for f in globfiles(files)])
+        
+    return cachedread
+    
+def fillcache(files, treename, branches):
+    """
+    Store `branches` of the tree `treename` of `files` in the branch cache, one column at a time,
+    such that chunked reads (e.g. iterTree with `chunksize`) then use it.
+    """
+    
+    read = _uproot_read if _isuproot() else lambda f, t, br, sel: root_numpy.root2array(f, t, br, sel)
+    branches = [branches] if isinstance(branches, str) else list(branches)
+    
+    return dict((f, BranchCache.fill(f, treename, branches, lambda br: read(f, treename, br, "")))
+                for f in globfiles(files))
+    
+def iterTree(files, treename='DecayTree', branches=None, selection='', chunksize=None, start=None, stop=None):
+    """
+    Iterate over a TTree, a ROOT file or a list of ROOT files and yield structured arrays of the
+    entries passing the selection. With `chunksize` the entries are read in ranges of at most
+    `chunksize` entries (before selection), such that the memory used does not depend on the
+    size of the files. Without it everything is read at once. `start` and `stop` restrict the
+    entries read in each file.
+    """
+    
+    oneshot = chunksize is None and start is None and stop is None
+    
+    if not isinstance(files, (str, list, tuple)):
+        # a TTree or TChain, selected by ROOT
+        read = lambda br, sel, **kw: root_numpy.tree2array(files, br, sel, **kw)
+        for a, b in ([(None, None)] if oneshot else _ranges(files.GetEntries(), chunksize, start, stop)):
+            yield _read(read, branches, selection, a, b, pushdown=True)
+        return
+        
+    readfiles = _uproot_read if _isuproot() else lambda f, t, br, sel, **kw: root_numpy.root2array(f, t, br, sel, **kw)
+    readfiles = _cachedread(readfiles)
+    
+    # root_numpy applies the selection while reading, unless the columns come from the cache
+    cached = BranchCache.enabled()
+    pushdown = not _isuproot() and not cached
+    
+    if oneshot:
+        # the compiled selections read the files one by one, as the entry ranges are per file
+        sources = [files] if pushdown else globfiles(files)
+        arrays = [_read(lambda br, sel, **kw: readfiles(s,treename,br,sel,**kw), branches, selection, pushdown=pushdown, cached=cached) 
+                  for s in sources]
+        yield arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+        return
+        
+    for f in globfiles(files):
+        for a, b in _ranges(nentries(f, treename), chunksize, start, stop):
+            yield _read(lambda br, sel, **kw: readfiles(f,treename,br,sel,**kw), branches, selection, a, b, pushdown, cached)
+    
+def _sample(chunks, branches, fraction=1.0, size=None, seed=None, folds=None, foldby=_foldby):
+    
+    # folds = (nfolds, fold or list of folds), applied before the random subsampling
+    if folds is not None:
+        chunks = Sampling.select_folds(chunks, folds[0], folds[1], foldby)
+        if branches is not None:
+            branches = [branches] if isinstance(branches, str) else list(branches)
+            chunks = (c[branches] for c in chunks)
+    if fraction != 1:
+        chunks = Sampling.bernoulli(chunks, fraction, seed)
+    if size is not None:
+        chunks = Sampling.reservoir(chunks, size, seed)
+        
+    return chunks
+    
+def _columns(branches, folds=None, foldby=_foldby):
+    
+    # the branches the folds are computed from are read as well
+    if branches is None or folds is None:
+        return branches
+    if isinstance(branches, str):
+        branches = [branches]
+        
+    return list(branches) + [b for b in foldby if b not in branches]
+    
+def readTree(file,selection='',treename='DecayTree',fraction=1,branches=None,size=None,seed=None,folds=None,foldby=_foldby,chunksize=1000000):
+    """
+    Read `branches` of the entries passing `selection` into a TTree. A subsample is taken while
+    reading chunks of `chunksize` entries: each entry is kept with probability `fraction`, and/or
+    `size` entries are sampled without replacement, reproducibly for a given `seed`. With
+    `folds` = (k, i) only the entries in fold i (or list of folds) out of k are kept, the folds
+    being a hash of the `foldby` branches, so that training/test splits are stable.
+    """
+    
+    if fraction == 1 and size is None and folds is None:
+        tree_array = next(iterTree(file,treename,branches,selection))
+    else:
+        chunks = iterTree(file,treename,_columns(branches,folds,foldby),selection,chunksize)
+        arrays = list(_sample(chunks,branches,fraction,size,seed,folds,foldby))
+        if not arrays:
+            arrays = [next(iterTree(file,treename,branches,selection,stop=0))]
+        tree_array = np.concatenate(arrays)
+        
+    if _isuproot():
+        # there is no TTree without ROOT
+        return tree_array
+        
+    return root_numpy.array2tree(tree_array,name=treename)
+    
+# ROOT compression algorithms, see ROOT::RCompressionSetting::EAlgorithm
+_algorithms = {"ZLIB": 1, "LZMA": 2, "LZ4": 4, "ZSTD": 5}
+
+def _compression(compression):
+    
+    # e.g. ("LZ4", 4), "ZSTD" or directly 100 * algorithm + level
+    if isinstance(compression, int):
+        return compression
+    if isinstance(compression, str):
+        compression = (compression, 4)
+        
+    algorithm, level = compression
+    return 100 * _algorithms[algorithm.upper()] + level
+    
+def _readchunk(file, treename, branches, selection, start, stop):
+    
+    return next(iterTree(file,treename,branches,selection,start=start,stop=stop))
+    
+def _readchunks(files, treename, branches, selection, chunksize, nworkers=None):
+    
+    files = globfiles(files)
+    counts = filecounts(files, treename, nworkers=nworkers)
+    tasks = [(f, treename, branches, selection, a, b) for f, (n, _) in zip(files, counts) for a, b in _ranges(n, chunksize)]
+    
+    if not nworkers:
+        for task in tasks:
+            yield _readchunk(*task)
+        return
+        
+    # at most 2 * nworkers chunks are read ahead of the writer
+    with ProcessPoolExecutor(nworkers) as executor:
+        pending = []
+        for task in tasks:
+            pending.append(executor.submit(_readchunk, *task))
+            if len(pending) >= 2 * nworkers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+            
+def _writetree(chunks, fileoutput, treename, compression=None, nevents=None):
+    
+    if _isuproot():
+        return _uproot_writetree(chunks, fileoutput, treename, compression, nevents)
+        
+    f = ROOT.TFile(fileoutput, "recreate")
+    if compression is not None:
+        f.SetCompressionSettings(_compression(compression))
+        
+    tree = None
+    n = 0
+    for chunk in chunks:
+        # the tree is created in the output file by the first chunk, then extended. Reading the
+        # chunks opens the input files, which changes the current directory.
+        f.cd()
+        tree = root_numpy.array2tree(chunk, name=treename, tree=tree)
+        n += len(chunk)
+        
+    f.cd()
+    if nevents is not None:
+        nev = ROOT.TTree("nevents", "nevents")
+        nev.SetEntries(1)
+        a_nevents  = np.zeros(1,dtype=np.float64)
+        br_nevents = nev.Branch( 'nevents', a_nevents, 'nevents/D')
+        nev.GetEntry(0)
+        a_nevents[0] = nevents
+        br_nevents.Fill()
+        
+    f.Write()
+    f.Close()
+    
+    return n
+    
+def mergefiles(files,treename,fileoutput,selection='',fraction=1.0,branches=None,chunksize=1000000,compression=None,nworkers=None,
+               size=None,seed=None,folds=None,foldby=_foldby):
+    """
+    Merge the tree `treename` of `files` into the tree 'DecayTree' of `fileoutput`, keeping only
+    `branches` (all by default) of the entries passing `selection`. The entries are streamed in
+    chunks of `chunksize` entries, read ahead by `nworkers` processes if given, so the merged
+    sample never has to fit in memory. `compression` is a ROOT algorithm and level, e.g.
+    ("LZ4", 4) for speed or ("ZSTD", 5) / ("LZMA", 8) for size. `fraction`, `size`, `seed`,
+    `folds` and `foldby` subsample the entries as in `readTree`.
+    """
+    
+    chunks = _readchunks(files, treename, _columns(branches, folds, foldby), selection, chunksize, nworkers)
+    chunks = _sample(chunks, branches, fraction, size, seed, folds, foldby)
+        
+    print(_writetree(chunks, fileoutput, 'DecayTree', compression))
+
+def Efficiency(tree_total,selection='',chunksize=1000000,treename='DecayTree'):
+    
+    if isinstance(tree_total, tchain):
+        treename, tree_total = tree_total.name, tree_total.files
+        
+    if isinstance(tree_total, (str, list, tuple)):
+        number_total = sum(n for n, _ in filecounts(globfiles(tree_total), treename))
+    else:
+        number_total = tree_total.GetEntries()
+    
+    cut = _compile(selection)
+    if cut is None:
+        # counted by TTreeFormula
+        if isinstance(tree_total, (str, list, tuple)):
+            tree_total = tchain(treename, tree_total).chain
+        number_passed = tree_total.GetEntries(selection)
+    elif not cut:
+        number_passed = number_total
+    else:
+        # only the branches used by the selection are read
+        number_passed = sum(cut.count(a) for a in iterTree(tree_total,treename,cut.branches,chunksize=chunksize))
     
     efficiency = float(number_passed/number_total)
     
@@ -165,8 +735,6 @@ def Efficiency(tree_total,selection=''):
 
     uncertainty = float(math.sqrt((M * (N - M))/math.pow(N,3)))
     
-    destruct_object(tree_passed)
-    
     return {"efficiency":efficiency, "error":uncertainty, "Nbefore":N, "Nafter":M}
     
 def NEfficiency(array_total,array_selection):
@@ -183,3 +751,119 @@ def NEfficiency(array_total,array_selection):
     
     return {"efficiency":efficiency, "error":uncertainty, "Nbefore":N, "Nafter":M}
 
+    
+class CutFlow(object):
+    """
+    Cut-flow of an ordered list of named cuts, computed in a single pass over the input (ROOT
+    file(s), TTree, tchain or structured array). For each cut it gives the number of entries
+    before and after it, the efficiency relative to the previous step and the cumulative one,
+    with binomial and Clopper-Pearson uncertainties, and weighted ones if `weights` is given.
+    
+    >>> flow = CutFlow([("PID", "K_PIDK > 0"), ("Mass", "abs(B_M - 5279) < 50")], weights="sw")
+    >>> flow.fill(files, chunksize=1000000)
+    >>> flow.tocsv("cutflow.csv")
+    """
+    
+    def __init__(self, cuts, weights=None, cl=Stats.ONE_SIGMA):
+        
+        if isinstance(cuts, dict):
+            cuts = list(cuts.items())
+            
+        self.cuts = list(cuts)
+        self.weights = weights
+        self.cl = cl
+        
+        n = len(self.cuts) + 1
+        # step 0 is the input, step i the entries passing the first i cuts
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.sumw = np.zeros(n)
+        self.sumw2 = np.zeros(n)
+        
+    def _columns(self):
+        
+        columns, masks = [], []
+        for _, selection in self.cuts:
+            cut = _compile(selection)
+            if cut is None:
+                # evaluated by TTreeFormula as an expression branch
+                expr = "({0})".format(selection)
+                columns.append(expr)
+                masks.append(lambda a, expr=expr: a[expr] != 0)
+            else:
+                columns += cut.branches
+                masks.append(cut.mask)
+                
+        if self.weights:
+            columns.append(self.weights)
+            
+        return sorted(set(columns), key=columns.index), masks
+        
+    def fill(self, input, treename='DecayTree', chunksize=1000000):
+        
+        columns, masks = self._columns()
+        
+        if isinstance(input, np.ndarray):
+            arrays = [input]
+        else:
+            if isinstance(input, tchain):
+                treename, input = input.name, input.files
+            arrays = iterTree(input, treename, columns, '', chunksize)
+            
+        for array in arrays:
+            passed = np.ones(len(array), dtype=bool)
+            w = np.asarray(array[self.weights], dtype=np.float64) if self.weights else None
+            
+            for i in range(len(self.cuts) + 1):
+                if i > 0:
+                    passed &= masks[i-1](array)
+                self.counts[i] += np.count_nonzero(passed)
+                if w is not None:
+                    self.sumw[i] += w[passed].sum()
+                    self.sumw2[i] += (w[passed]**2).sum()
+                    
+        return self
+        
+    def table(self):
+        """List of rows, one per cut, with the counts and efficiencies."""
+        
+        rows = []
+        N, W, W2 = self.counts[0], self.sumw[0], self.sumw2[0]
+        
+        for i, (name, selection) in enumerate(self.cuts, 1):
+            before, after = self.counts[i-1], self.counts[i]
+            low, high = Stats.clopper_pearson(after, before, self.cl)
+            clow, chigh = Stats.clopper_pearson(after, N, self.cl)
+            
+            row = {"name": name, "selection": selection, "Nbefore": int(before), "Nafter": int(after),
+                   "efficiency": float(Stats.efficiency(after, before)),
+                   "error": float(Stats.binomial_error(after, before)),
+                   "cp_low": float(low), "cp_high": float(high),
+                   "cumulative": float(Stats.efficiency(after, N)),
+                   "cumulative_error": float(Stats.binomial_error(after, N)),
+                   "cumulative_cp_low": float(clow), "cumulative_cp_high": float(chigh)}
+            
+            if self.weights:
+                row.update({"Wbefore": float(self.sumw[i-1]), "Wafter": float(self.sumw[i]),
+                            "weighted_efficiency": float(Stats.efficiency(self.sumw[i], self.sumw[i-1])),
+                            "weighted_error": float(Stats.weighted_error(self.sumw[i], self.sumw[i-1], self.sumw2[i], self.sumw2[i-1])),
+                            "weighted_cumulative": float(Stats.efficiency(self.sumw[i], W)),
+                            "weighted_cumulative_error": float(Stats.weighted_error(self.sumw[i], W, self.sumw2[i], W2))})
+                
+            rows.append(row)
+            
+        return rows
+        
+    def tojson(self, filename):
+        
+        with open(filename, "w") as f:
+            json.dump(self.table(), f, indent=2)
+            
+    def tocsv(self, filename):
+        
+        import csv
+        
+        rows = self.table()
+        with open(filename, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ["name"])
+            writer.writeheader()
+            writer.writerows(rows)
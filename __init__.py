@@ -30,10 +30,13 @@ def cyan( text ):
 def yellow( text ):
     return "{0}{1}{2}".format( _yellow, text, _default)
     
-from .dependencies import softimport
+from .dependencies import softimport, backend
     
-import sys
-if sys.version_info[0] < 3:
-    sys.path.append('/share/lphe/home/marinang/SimulationProduction/EvtTypes/MG5_aMC_v2_6_7')
-    from madgraph.various import lhe_parser
+def __getattr__(name):
+    
+    # the MadGraph LHE parser is loaded from the madgraph backend when first used
+    if name == "lhe_parser":
+        return backend("madgraph")
+        
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
@@ -1,3 +1,16 @@
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+# Time spent importing each softimported module, see `import_report`.
+_import_times = {}
+
+# Set UTILITIES_IMPORT_PROFILE=1 to print the time of each lazy import when it happens.
+_profile = bool(os.environ.get("UTILITIES_IMPORT_PROFILE"))
+
+
 class DelayedImportError(object):
   # When a module is strictly softimported but is not available, this
   # object is a placeholder for the module. The user will get the
@@ -10,37 +23,207 @@ class DelayedImportError(object):
     raise self.err
 
 
+def _import(modulename, asname=None, package=None):
+  # `import a.b` binds the top-level package `a`, `import a.b as c` binds
+  # the submodule itself, as does a relative import `.b`.
+
+  start = time.time()
+  module = importlib.import_module(modulename, package)
+  elapsed = time.time() - start
+
+  _import_times[modulename] = _import_times.get(modulename, 0.) + elapsed
+  if _profile:
+    sys.stderr.write("softimport: {0} imported in {1:.3f} s\n".format(modulename, elapsed))
+
+  if asname is None and not modulename.startswith("."):
+    module = sys.modules[modulename.split(".")[0]]
+
+  return module
+
+
 class LazyModule(object):
-  # When a module is lazily softimported, it will always be represented
-  # with this object as a placeholder. It will repeatedly attempt to
-  # import the module every time the user tries to use it (unlike strict,
-  # which gives up after the first attempt on startup).
-  #
-  # Unlike strict, the module will always be wrapped by this object,
-  # even if the module is available. Users will be able to see
-  # the sausage-making if they're inclined to do `type(root_numpy)`.
-
-  def __init__(self, name):
-    self.name = name
-    self.module = None
+  # When a module is lazily softimported, it is represented by this object
+  # until it is used for the first time. The module is then imported once,
+  # and the placeholder bound in the namespace of the importing module is
+  # replaced by the real module, so that later uses do not go through
+  # `__getattr__`. A failed import is remembered and raised again on every
+  # later use, without trying to import the module again.
+
+  def __init__(self, name, asname=None, namespace=None, package=None, onload=None):
+    d = self.__dict__
+    d["_name"] = name
+    d["_asname"] = asname
+    d["_namespace"] = namespace
+    d["_package"] = package
+    d["_onload"] = onload
+    d["_module"] = None
+    d["_error"] = None
+
+  def _bindname(self):
+    if self._asname is not None:
+      return self._asname
+    elif self._name.startswith("."):
+      return self._name.split(".")[-1]
+    else:
+      return self._name.split(".")[0]
+
+  def _resolve(self):
+    module = self._module
+    if module is not None:
+      return module
+    if self._error is not None:
+      raise self._error
+
+    try:
+      module = _import(self._name, self._asname, self._package)
+    except ImportError as err:
+      self.__dict__["_error"] = err
+      raise
+
+    self.__dict__["_module"] = module
+    if self._onload is not None:
+      self._onload(module)
+
+    namespace = self._namespace
+    if namespace is not None and namespace.get(self._bindname()) is self:
+      namespace[self._bindname()] = module
+
+    return module
 
   def __getattr__(self, attr):
-    if self.module is None:
-      self.module = __import__(self.name)
-    return getattr(self.module, attr)
+    return getattr(self._resolve(), attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._resolve(), attr, value)
+
+  def __dir__(self):
+    return dir(self._resolve())
+
+  def __repr__(self):
+    state = "loaded" if self._module is not None else "not loaded"
+    return "<lazy module {0!r} ({1})>".format(self._name, state)
 
 
-def softimport(modulename, lazy=True):
+def softimport(modulename, lazy=True, asname=None, onload=None):
   """
   The function that one calls to import a module softly.
+
+  With `lazy` the module is only imported when it is first used, and it then
+  replaces the placeholder in the namespace of the caller under `asname`
+  (by default the name an `import` statement would bind). `onload` is called
+  with the module once it is imported. Relative names (".Hist") are resolved
+  against the package of the caller.
   """
-  # Once we vote on "always strict" or "always lazy," we should _take out_
-  # the other functionality so that it isn't even an option.
+
+  caller = sys._getframe(1).f_globals
+  package = caller.get("__package__")
 
   if lazy:
-    return LazyModule(modulename)
+    return LazyModule(modulename, asname, caller, package, onload)
   else:
     try:
-      return __import__(modulename)
+      module = _import(modulename, asname, package)
     except ImportError as err:
-      return DelayedImportError(err)
\ No newline at end of file
+      return DelayedImportError(err)
+    if onload is not None:
+      onload(module)
+    return module
+
+
+def import_report(stream=None):
+  """Print the time spent importing each softimported module, slowest first."""
+
+  stream = stream or sys.stdout
+  for name, elapsed in sorted(_import_times.items(), key=lambda i: -i[1]):
+    stream.write("{0:<40} {1:8.3f} s\n".format(name, elapsed))
+
+
+# Registry of the backends which are not plain packages (e.g. madgraph), the
+# modules being otherwise imported lazily with `softimport`. A backend is
+# loaded the first time it is requested with `backend`, and a failure to load
+# it is remembered as for lazy modules.
+_backends = {}
+
+
+def register_backend(name, loader):
+  """Register `loader`, a function returning the module of the backend `name`."""
+
+  _backends[name] = {"loader": loader, "module": None, "error": None}
+
+
+def backend(name):
+  """The module of the backend `name`, loaded on first request."""
+
+  try:
+    entry = _backends[name]
+  except KeyError:
+    raise ValueError("Unknown backend {0}! Registered backends: {1}".format(name, sorted(_backends)))
+
+  if entry["module"] is None:
+    if entry["error"] is not None:
+      raise entry["error"]
+    try:
+      entry["module"] = entry["loader"]()
+    except ImportError as err:
+      entry["error"] = err
+      raise
+
+  return entry["module"]
+
+
+def backends():
+  """State of the registered backends: "loaded", "unavailable" or "not loaded"."""
+
+  states = {}
+  for name, entry in _backends.items():
+    if entry["module"] is not None:
+      states[name] = "loaded"
+    elif entry["error"] is not None:
+      states[name] = "unavailable"
+    else:
+      states[name] = "not loaded"
+
+  return states
+
+
+def _madgraph():
+  # MG5_aMC is not installed as a package, MADGRAPH_PATH points to its directory
+  path = os.environ.get("MADGRAPH_PATH", "/share/lphe/home/marinang/SimulationProduction/EvtTypes/MG5_aMC_v2_6_7")
+  if path not in sys.path:
+    sys.path.append(path)
+  return _import("madgraph.various.lhe_parser", asname="lhe_parser")
+
+
+register_backend("madgraph", _madgraph)
+
+
+def startup_time(module="Utilities", repeat=5):
+  """Best wall time, in seconds, of `import module` in a fresh interpreter."""
+
+  code = "import time; t = time.time(); import {0}; print(time.time() - t)".format(module)
+  times = []
+  for _ in range(repeat):
+    output = subprocess.check_output([sys.executable, "-c", code])
+    times.append(float(output.decode().strip().splitlines()[-1]))
+
+  return min(times)
+
+
+if __name__ == "__main__":
+
+  # startup benchmark: python -m Utilities.dependencies [--max SECONDS] [modules ...]
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Measure the import time of Utilities modules.")
+  parser.add_argument("modules", nargs="*", default=["Utilities", "Utilities.Tree", "Utilities.Hist"])
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--max", type=float, default=None, help="fail if an import takes longer (s)")
+  args = parser.parse_args()
+
+  failed = False
+  for m in args.modules:
+    elapsed = startup_time(m, args.repeat)
+    print("{0:<40} {1:8.3f} s".format(m, elapsed))
+    failed = failed or (args.max is not None and elapsed > args.max)
+
+  sys.exit(1 if failed else 0)
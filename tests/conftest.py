@@ -0,0 +1,13 @@
+import importlib.util
+import os
+import sys
+
+# the repository is the Utilities package itself, imported here under its name
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "Utilities" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("Utilities", os.path.join(_root, "__init__.py"),
+                                                  submodule_search_locations=[_root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["Utilities"] = module
+    spec.loader.exec_module(module)
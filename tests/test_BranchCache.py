@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from Utilities import BranchCache, Tree
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("UTILITIES_CACHE", str(tmp_path / "cache"))
+    BranchCache.enable("1G")
+    yield
+    BranchCache.disable()
+
+
+@pytest.fixture
+def rootfile(tmp_path, monkeypatch):
+
+    # a file on disk for the cache keys, read through a fake uproot backend
+    path = tmp_path / "file.root"
+    path.write_bytes(b"")
+
+    data = np.zeros(1000, dtype=[("x", np.float64), ("y", np.int32)])
+    data["x"] = np.arange(1000)
+    data["y"] = np.arange(1000) % 3
+    reads = []
+
+    def read(files, treename, branches, selection, start=None, stop=None):
+        assert not selection
+        reads.append((list(branches), start, stop))
+        return data[start:stop][branches].copy()
+
+    monkeypatch.setattr(Tree, "_isuproot", lambda: True)
+    monkeypatch.setattr(Tree, "_uproot_read", read)
+    monkeypatch.setattr(Tree, "nentries", lambda f, t: len(data))
+
+    return str(path), data, reads
+
+
+def test_selected_read_fills_cache(cache, rootfile):
+
+    path, data, reads = rootfile
+
+    first = next(Tree.iterTree(path, "t", ["x"], "x > 100 && y == 1"))
+    assert len(reads) > 0
+    assert sorted(c["branch"] for c in BranchCache.entries()) == ["x", "y"]
+
+    del reads[:]
+    second = next(Tree.iterTree(path, "t", ["x"], "x > 100 && y == 1"))
+    assert reads == []
+
+    expected = data[(data["x"] > 100) & (data["y"] == 1)]["x"]
+    np.testing.assert_array_equal(first["x"], expected)
+    np.testing.assert_array_equal(second["x"], expected)
+
+
+def test_chunked_miss_reads_chunk(cache, rootfile):
+
+    path, data, reads = rootfile
+
+    chunks = list(Tree.iterTree(path, "t", ["x", "y"], chunksize=300))
+    assert [(a, b) for _, a, b in reads] == [(0, 300), (300, 600), (600, 900), (900, 1000)]
+    assert BranchCache.entries() == []
+    np.testing.assert_array_equal(np.concatenate(chunks), data)
+
+    Tree.fillcache(path, "t", ["x", "y"])
+    del reads[:]
+    chunks = list(Tree.iterTree(path, "t", ["x", "y"], chunksize=300))
+    assert reads == []
+    np.testing.assert_array_equal(np.concatenate(chunks), data)
+
+
+def test_object_columns_not_cached(cache, tmp_path):
+
+    path = tmp_path / "file.root"
+    path.write_bytes(b"")
+    jagged = np.empty(5, dtype=object)
+    for i in range(5):
+        jagged[i] = np.arange(i)
+    data = np.zeros(5, dtype=[("x", np.float64), ("j", object)])
+    data["x"], data["j"] = np.arange(5), jagged
+
+    reads = []
+    def reader(branches, start=None, stop=None):
+        reads.append((branches, start, stop))
+        return data[start:stop][branches]
+
+    BranchCache.read(str(path), "t", ["x", "j"], reader)
+    assert [c["branch"] for c in BranchCache.entries()] == ["x"]
+
+    del reads[:]
+    array = BranchCache.read(str(path), "t", ["x", "j"], reader, 1, 3)
+    assert reads == [(["j"], 1, 3)]
+    np.testing.assert_array_equal(array["x"], [1, 2])
+    np.testing.assert_array_equal(array["j"][1], [0, 1])
+
+
+@pytest.mark.parametrize("value, enabled, maxsize", [("", False, 10 * 1024**3), ("yes", True, 10 * 1024**3),
+                                                     ("TRUE", True, 10 * 1024**3), ("20G", True, 20 * 1024**3),
+                                                     ("off", False, 10 * 1024**3), ("lots", True, 10 * 1024**3)])
+def test_environment(monkeypatch, value, enabled, maxsize):
+
+    import importlib
+    import warnings
+
+    monkeypatch.setenv("UTILITIES_BRANCH_CACHE", value)
+    module = importlib.reload(BranchCache)
+    try:
+        assert module.enabled() == enabled
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            assert module._maxsize() == maxsize
+    finally:
+        monkeypatch.delenv("UTILITIES_BRANCH_CACHE")
+        importlib.reload(BranchCache)
@@ -0,0 +1,208 @@
+import numpy as np
+import pytest
+
+from Utilities.Hist import BinningScheme, EfficiencyMap, QuantileSketch
+
+
+def _sample(n=1000, seed=1):
+
+    rng = np.random.RandomState(seed)
+    array = np.zeros(n, dtype=[("x", np.float64), ("y", np.float64)])
+    array["x"] = rng.uniform(0, 10, n)
+    array["y"] = rng.normal(0, 1, n)
+    return array
+
+
+def test_efficiency_map_mask_selection():
+
+    array = _sample()
+    mask = array["y"] > 0
+
+    effmap = EfficiencyMap("x", {"passed": mask}, "eff", nbins=5, xmin=0, xmax=10).fill(array)
+    reference = EfficiencyMap("x", {"passed": "y > 0"}, "ref", nbins=5, xmin=0, xmax=10).fill(array)
+
+    np.testing.assert_array_equal(effmap.passed["passed"].sumw, reference.passed["passed"].sumw)
+    np.testing.assert_array_equal(effmap.passed["passed"].contents, np.histogram(array["x"][mask], 5, (0, 10))[0])
+    np.testing.assert_array_equal(effmap.total.contents, np.histogram(array["x"], 5, (0, 10))[0])
+
+
+def test_lookup_profile_means():
+
+    from Utilities.Hist import HistLookup, NumpyProfile
+
+    array = _sample()
+    profile = NumpyProfile([np.linspace(0, 10, 6)])
+    profile.fill((array["x"], array["y"]))
+
+    values, errors = HistLookup.fromhist(profile).lookup(np.array([1., 9.]))
+    inbin = [(array["x"] >= 0) & (array["x"] < 2), (array["x"] >= 8) & (array["x"] < 10)]
+    np.testing.assert_allclose(values, [array["y"][m].mean() for m in inbin])
+    np.testing.assert_allclose(errors, [array["y"][m].std() / np.sqrt(m.sum()) for m in inbin])
+
+
+def test_findbins():
+
+    from Utilities.Hist import ArrayHist
+
+    x = np.array([-1., 0., 0.5, 9.999999999, 10., np.nan, 3.3])
+    uniform = ArrayHist([np.linspace(0, 10, 11)], [True])
+    variable = ArrayHist([np.array([0., 1., 2.5, 10.])])
+
+    np.testing.assert_array_equal(uniform.findbins(x), [0, 1, 1, 10, 11, 11, 4])
+    np.testing.assert_array_equal(variable.findbins(x), np.digitize(x, [0., 1., 2.5, 10.]))
+
+
+def _numpyhist(array, edges, weights=None):
+
+    from Utilities.Hist import NumpyHist
+
+    hist = NumpyHist(edges)
+    hist.fill([array[v] for v in ("x", "y")][:len(edges)], weights)
+    return hist
+
+
+def test_numpyhist_matches_histogramdd():
+
+    array = _sample()
+    edges = [np.linspace(0, 10, 11), np.array([-3., -1., 0., 0.5, 3.])]
+    hist = _numpyhist(array, edges, array["x"])
+
+    reference = np.histogramdd(np.column_stack([array["x"], array["y"]]), edges, weights=array["x"])[0]
+    reference2 = np.histogramdd(np.column_stack([array["x"], array["y"]]), edges, weights=array["x"]**2)[0]
+    np.testing.assert_allclose(hist.contents, reference)
+    np.testing.assert_allclose(hist.errors, np.sqrt(reference2))
+    assert hist.shape == (10, 4)
+
+
+def test_rebin_and_project():
+
+    array = _sample()
+    edges = [np.linspace(0, 10, 11), np.array([-3., -1., 0., 0.5, 3.])]
+    hist = _numpyhist(array, edges)
+
+    rebinned = hist.rebin(5, axis=0)
+    np.testing.assert_array_equal(rebinned.edges[0], [0., 5., 10.])
+    np.testing.assert_allclose(rebinned.contents, hist.contents.reshape(2, 5, 4).sum(axis=1))
+    np.testing.assert_allclose(rebinned.sumw.sum(), hist.sumw.sum())
+
+    rebinned = hist.rebin(2, axis=1)
+    np.testing.assert_allclose(rebinned.contents, hist.contents.reshape(10, 2, 2).sum(axis=2))
+
+    with pytest.raises(ValueError):
+        hist.rebin(3, axis=0)
+
+    # the projections include the under- and overflows of the other axis
+    np.testing.assert_allclose(hist.project(0).contents, np.histogram(array["x"], edges[0])[0])
+    np.testing.assert_allclose(hist.project(1).sumw.sum(), len(array))
+    np.testing.assert_allclose(hist.project(1).contents, np.histogram(array["y"], edges[1])[0])
+
+
+def test_divide():
+
+    array = _sample()
+    edges = [np.linspace(0, 10, 6)]
+    total = _numpyhist(array, edges)
+    passed = _numpyhist(array[array["y"] > 0], edges)
+
+    eff = passed.divide(total, binomial=True)
+    n, k = total.contents, passed.contents
+    np.testing.assert_allclose(eff.contents, k / n)
+    np.testing.assert_allclose(eff.errors, np.sqrt(k / n * (1 - k / n) / n))
+
+    ratio = passed.divide(total)
+    np.testing.assert_allclose(ratio.errors, np.sqrt(k / n**2 + k**2 / n**3))
+
+    with pytest.raises(ValueError):
+        passed.divide(_numpyhist(array, [np.linspace(0, 10, 3)]))
+
+
+def test_add_and_scale():
+
+    array = _sample()
+    edges = [np.linspace(0, 10, 6)]
+    a, b = _numpyhist(array[:400], edges), _numpyhist(array[400:], edges)
+
+    np.testing.assert_allclose(sum([a, b]).contents, _numpyhist(array, edges).contents)
+    scaled = a.copy().scale(2.)
+    np.testing.assert_allclose(scaled.contents, 2 * a.contents)
+    np.testing.assert_allclose(scaled.errors, 2 * a.errors)
+
+
+def test_lookup_interpolation():
+
+    interpolate = pytest.importorskip("scipy.interpolate")
+    from Utilities.Hist import HistLookup
+
+    xedges, yedges = np.linspace(0, 4, 5), np.array([0., 1., 3., 6.])
+    values = np.arange(20.).reshape(5, 4) ** 1.5
+    lookup = HistLookup([xedges, yedges], values, interpolate=True)
+
+    rng = np.random.RandomState(4)
+    xc, yc = (xedges[1:] + xedges[:-1]) / 2, (yedges[1:] + yedges[:-1]) / 2
+    x, y = rng.uniform(xc[0], xc[-1], 100), rng.uniform(yc[0], yc[-1], 100)
+
+    reference = interpolate.RegularGridInterpolator((xc, yc), values[1:, 1:])(np.column_stack([x, y]))
+    np.testing.assert_allclose(lookup.lookup(x, y)[0], reference)
+
+    # beyond the outer bin centres the values are constant, as TH1::Interpolate
+    np.testing.assert_allclose(lookup.lookup([0.1, 3.9], [4.5, 4.5])[0], values[[1, 4], 3])
+
+    lookup = HistLookup([xedges, yedges], values, outofrange="fill", fill_value=-1.)
+    np.testing.assert_allclose(lookup.lookup([0.5, 5., 2.5], [0.5, 0.5, 7.])[0], [values[1, 1], -1., -1.])
+    lookup = HistLookup([xedges, yedges], values, outofrange="clip")
+    np.testing.assert_allclose(lookup.lookup([-1., 5.], [0.5, 9.])[0], [values[1, 1], values[4, 3]])
+
+
+def test_quantile_sketch():
+
+    rng = np.random.RandomState(6)
+    data = rng.lognormal(0, 1, 200000)
+    q = np.linspace(0, 1, 21)[1:-1]
+
+    sketch = QuantileSketch(compression=1000)
+    for chunk in np.array_split(data, 7):
+        sketch.update(chunk)
+    ranks = np.searchsorted(np.sort(data), sketch.quantile(q)) / float(len(data))
+    np.testing.assert_allclose(ranks, q, atol=2e-3)
+
+    # merging sketches of parts of the data
+    a, b = QuantileSketch().update(data[:50000]), QuantileSketch().update(data[50000:])
+    ranks = np.searchsorted(np.sort(data), a.merge(b).quantile(q)) / float(len(data))
+    np.testing.assert_allclose(ranks, q, atol=2e-3)
+    assert sketch.quantile(0.) == data.min() and sketch.quantile(1.) == data.max()
+
+
+def test_binning_builders():
+
+    rng = np.random.RandomState(7)
+    data = rng.normal(0, 1, 100000)
+
+    scheme = BinningScheme.fromQuantiles(data, 10, xmin=-5, xmax=5)
+    assert scheme.nBins() == 10 and scheme.edges[0] == -5 and scheme.edges[-1] == 5
+    counts = np.histogram(data, scheme.edges)[0]
+    np.testing.assert_allclose(counts, len(data) / 10., rtol=0.03)
+
+    scheme = BinningScheme.fromMinimumCounts(data, 5000, xmin=-4, xmax=4)
+    counts = np.histogram(data, scheme.edges)[0]
+    assert counts.min() >= 5000 - 1e-9
+    assert scheme.edges[0] == -4 and scheme.edges[-1] == 4
+
+    # two uniform densities: the blocks change close to the step
+    data = np.concatenate([rng.uniform(0, 1, 2000), rng.uniform(1, 2, 8000)])
+    scheme = BinningScheme.fromBayesianBlocks(data, xmin=0, xmax=2)
+    inner = scheme.edges[1:-1]
+    assert 1 <= len(inner) <= 3
+    assert np.min(np.abs(inner - 1.)) < 0.01
+
+
+def test_binning_scheme_edits():
+
+    scheme = BinningScheme(0., 10.)
+    scheme.addUniformBins(5, 0., 5.)
+    scheme.addBin(7.5)
+    np.testing.assert_allclose(scheme.Bins, [0., 1., 2., 3., 4., 5., 7.5, 10.])
+    np.testing.assert_array_equal(scheme.findBin([-1., 0., 7.5, 10.]), [0, 1, 7, 8])
+
+    # bins overlapping an existing edge are refused
+    scheme.addUniformBins(4, 6., 10.)
+    assert scheme.nBins() == 7
@@ -0,0 +1,71 @@
+import numpy as np
+
+from Utilities import Sampling
+
+
+def _chunks(array, chunksize):
+    return (array[a:a+chunksize] for a in range(0, len(array), chunksize))
+
+
+def _array(n=10000):
+
+    array = np.zeros(n, dtype=[("runNumber", np.int64), ("eventNumber", np.int64), ("x", np.float64)])
+    array["runNumber"] = 1000 + np.arange(n) // 1000
+    array["eventNumber"] = np.arange(n)
+    array["x"] = np.arange(n)
+    return array
+
+
+def test_streams_are_independent():
+
+    # the same seed gives different random numbers to the two samplings
+    assert not np.array_equal(Sampling._randomstate(7, 0).random_sample(100),
+                              Sampling._randomstate(7, 1).random_sample(100))
+
+
+def test_bernoulli_does_not_depend_on_chunking():
+
+    array = _array()
+    a = np.concatenate(list(Sampling.bernoulli(_chunks(array, 1000), 0.3, seed=1)))
+    b = np.concatenate(list(Sampling.bernoulli(_chunks(array, 333), 0.3, seed=1)))
+
+    np.testing.assert_array_equal(a, b)
+    assert abs(len(a) - 3000) < 5 * np.sqrt(10000 * 0.3 * 0.7)
+
+
+def test_reservoir():
+
+    array = _array()
+    sample = next(Sampling.reservoir(_chunks(array, 700), 500, seed=2))
+
+    assert len(sample) == 500
+    assert len(np.unique(sample["x"])) == 500
+    assert np.all(np.diff(sample["x"]) > 0)
+
+    small = next(Sampling.reservoir(_chunks(array[:100], 30), 500, seed=2))
+    np.testing.assert_array_equal(small, array[:100])
+
+
+def test_reservoir_is_uniform():
+
+    # each entry is sampled with probability size / n
+    array = _array(100)
+    counts = np.zeros(100)
+    for seed in range(2000):
+        counts[next(Sampling.reservoir(_chunks(array, 17), 10, seed=seed))["eventNumber"]] += 1
+
+    expected = 2000 * 10 / 100.
+    assert np.all(np.abs(counts - expected) < 5 * np.sqrt(expected))
+
+
+def test_folds():
+
+    array = _array()
+    folds = Sampling.fold(array, 5)
+
+    assert set(np.unique(folds)) == set(range(5))
+    np.testing.assert_array_equal(folds, Sampling.fold(array[::-1], 5)[::-1])
+    np.testing.assert_allclose(np.bincount(folds) / float(len(array)), 0.2, atol=0.02)
+
+    selected = np.concatenate(list(Sampling.select_folds(_chunks(array, 999), 5, [1, 3])))
+    np.testing.assert_array_equal(selected, array[np.isin(folds, [1, 3])])
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from Utilities.Selection import Selection, compile_selection
+
+
+@pytest.fixture
+def array():
+
+    rng = np.random.RandomState(3)
+    array = np.zeros(1000, dtype=[("B_PT", np.float64), ("B_ETA", np.float64), ("nTracks", np.int32),
+                                  ("K_ID", np.int32)])
+    array["B_PT"] = rng.exponential(2000, 1000)
+    array["B_ETA"] = rng.uniform(2, 5, 1000)
+    array["nTracks"] = rng.randint(0, 400, 1000)
+    array["K_ID"] = rng.choice([-321, 321], 1000)
+    return array
+
+
+@pytest.mark.parametrize("expression, reference", [
+    ("B_PT > 1000", lambda a: a["B_PT"] > 1000),
+    ("B_PT > 1000 && abs(B_ETA - 3.5) < 1", lambda a: (a["B_PT"] > 1000) & (np.abs(a["B_ETA"] - 3.5) < 1)),
+    ("B_PT < 500 || !(nTracks < 200)", lambda a: (a["B_PT"] < 500) | ~(a["nTracks"] < 200)),
+    ("TMath::Abs(K_ID) == 321 && K_ID > 0", lambda a: a["K_ID"] == 321),
+    ("sqrt(pow(B_PT, 2)) >= 1e3", lambda a: a["B_PT"] >= 1e3),
+    ("nTracks % 2 == 1", lambda a: a["nTracks"] % 2 == 1),
+    ("1 + 2 * 3 == 7 && B_ETA > 2 + 1", lambda a: a["B_ETA"] > 3),
+    ("(nTracks & 1) != 0", lambda a: a["nTracks"] % 2 == 1),
+    ("-B_ETA < -4", lambda a: a["B_ETA"] > 4),
+    ("max(B_PT, 3000) == 3000", lambda a: a["B_PT"] <= 3000),
+])
+def test_mask(array, expression, reference):
+
+    np.testing.assert_array_equal(compile_selection(expression).mask(array), reference(array))
+
+
+def test_branches_and_apply(array):
+
+    cut = compile_selection("B_PT > 1000 && abs(B_ETA - 3) < 1")
+
+    assert sorted(cut.branches) == ["B_ETA", "B_PT"]
+    assert cut.columns(["nTracks", "B_PT"]) == ["nTracks", "B_PT", "B_ETA"]
+    assert cut.columns(None) is None
+
+    selected = cut.apply(array, ["nTracks"])
+    assert selected.dtype.names == ("nTracks",)
+    np.testing.assert_array_equal(selected["nTracks"], array["nTracks"][cut.mask(array)])
+    assert cut.count(array) == len(selected)
+
+
+def test_empty_and_constant(array):
+
+    assert not Selection("")
+    assert compile_selection("").mask(array).all()
+    assert compile_selection("  ").apply(array) is array
+    assert not compile_selection("0").mask(array).any()
+    assert compile_selection("true").mask(array).all()
+
+
+def test_dictionary_input():
+
+    arrays = {"x": np.arange(5.), "y": np.array([1, 0, 1, 0, 1])}
+    np.testing.assert_array_equal(compile_selection("x > 1 && y").mask(arrays), [False, False, True, False, True])
+
+
+def test_cached():
+
+    assert compile_selection("x > 1") is compile_selection("x > 1")
+    cut = Selection("x > 1")
+    assert compile_selection(cut) is cut
+
+
+@pytest.mark.parametrize("expression", ["Sum$(x > 1) > 0", "x >", "(x > 1", "x > 1)", "x @ 1", "unknown(x)"])
+def test_unsupported(expression):
+
+    with pytest.raises(ValueError):
+        Selection(expression)
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+scipy_stats = pytest.importorskip("scipy.stats")
+
+from Utilities import Stats
+
+passed = np.array([0, 1, 5, 37, 50, 99, 100])
+total = np.array([100, 100, 100, 100, 100, 100, 100])
+
+
+def _reference(method, cl):
+
+    intervals = [scipy_stats.binomtest(int(k), int(n)).proportion_ci(cl, method=method) for k, n in zip(passed, total)]
+    return np.array([i.low for i in intervals]), np.array([i.high for i in intervals])
+
+
+@pytest.mark.parametrize("cl", [Stats.ONE_SIGMA, 0.9, 0.95])
+def test_clopper_pearson(cl):
+
+    low, high = Stats.clopper_pearson(passed, total, cl)
+    ref_low, ref_high = _reference("exact", cl)
+
+    np.testing.assert_allclose(low, ref_low, atol=1e-10)
+    np.testing.assert_allclose(high, ref_high, atol=1e-10)
+
+
+@pytest.mark.parametrize("cl", [Stats.ONE_SIGMA, 0.95])
+def test_wilson(cl):
+
+    low, high = Stats.wilson(passed, total, cl)
+    ref_low, ref_high = _reference("wilson", cl)
+
+    np.testing.assert_allclose(low, ref_low, atol=1e-10)
+    np.testing.assert_allclose(high, ref_high, atol=1e-10)
+
+
+def test_bayesian():
+
+    low, high = Stats.bayesian(passed, total, 0.9)
+    ref_low, ref_high = scipy_stats.beta.interval(0.9, passed + 1, total - passed + 1)
+
+    np.testing.assert_allclose(low, ref_low)
+    np.testing.assert_allclose(high, ref_high)
+
+    # Jeffreys prior
+    low, high = Stats.bayesian(passed, total, 0.9, alpha=0.5, beta=0.5)
+    np.testing.assert_allclose(low, scipy_stats.beta.ppf(0.05, passed + 0.5, total - passed + 0.5))
+
+
+def test_empty_total():
+
+    for method in ("clopper_pearson", "wilson", "bayesian", "normal"):
+        low, high = Stats.interval([0], [0], method)
+        assert 0. <= low[0] <= high[0] <= 1.
+
+    assert Stats.efficiency([1.], [0.])[0] == 0.
+    assert Stats.binomial_error([0.], [0.])[0] == 0.
+
+    with pytest.raises(ValueError):
+        Stats.interval(passed, total, "unknown")
+
+
+def test_binomial_and_weighted_errors():
+
+    eff = passed / total.astype(float)
+    np.testing.assert_allclose(Stats.binomial_error(passed, total), np.sqrt(eff * (1 - eff) / total))
+
+    # with unit weights the weighted error is the binomial one
+    np.testing.assert_allclose(Stats.weighted_error(passed, total, passed, total), Stats.binomial_error(passed, total))
+
+
+def test_weighted_error_toys():
+
+    # spread of the weighted efficiency of toys
+    rng = np.random.RandomState(5)
+    weights = rng.uniform(0.5, 2., 2000)
+    effs, errors = [], []
+    for _ in range(500):
+        mask = rng.random_sample(2000) < 0.3
+        effs.append(weights[mask].sum() / weights.sum())
+        errors.append(Stats.weighted_error(weights[mask].sum(), weights.sum(), (weights[mask]**2).sum(), (weights**2).sum()))
+
+    assert np.std(effs) == pytest.approx(np.mean(errors), rel=0.1)
+
+
+def test_residuals():
+
+    observed = np.array([0., 3., 10., 7.])
+    expected = np.array([1.5, 3., 8., 9.])
+
+    residuals = Stats.deviance_residuals(observed, expected)
+    chi2 = 2 * np.sum(expected - observed + np.where(observed > 0, observed * np.log(np.where(observed > 0, observed, 1.) / expected), 0.))
+
+    assert np.sum(residuals**2) == pytest.approx(chi2)
+    np.testing.assert_array_equal(np.sign(residuals), [-1, 0, 1, -1])
+    np.testing.assert_allclose(Stats.pulls(observed, expected, [1., 0., 2., 2.]), [-1.5, 0., 1., -1.])
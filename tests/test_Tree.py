@@ -0,0 +1,50 @@
+import importlib.util
+
+import numpy as np
+import pytest
+
+from Utilities import Tree
+
+
+class _FakeTree(object):
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def keys(self, recursive=False):
+        return list(self.columns)
+
+    def arrays(self, filter_name, entry_start=None, entry_stop=None, library="np", decompression_executor=None):
+        return dict((k, v[entry_start:entry_stop]) for k, v in self.columns.items() if filter_name(k))
+
+
+class _FakeFile(dict):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def test_uproot_exact_branch_names(monkeypatch):
+
+    columns = {"a*": np.arange(5.), "ab": np.arange(5) * 2., "a[0]": np.arange(5) * 3., "a0": np.zeros(5)}
+
+    class uproot(object):
+        @staticmethod
+        def open(file):
+            return _FakeFile(t=_FakeTree(columns))
+
+    monkeypatch.setattr(Tree, "uproot", uproot)
+
+    array = Tree._uproot_arrays("file.root", "t", ["a*", "a[0]"], 1, 4)
+    assert array.dtype.names == ("a*", "a[0]")
+    np.testing.assert_array_equal(array["a[0]"], [3., 6., 9.])
+
+
+@pytest.mark.skipif(importlib.util.find_spec("ROOT") is not None, reason="ROOT is available")
+def test_tview_needs_root():
+
+    with pytest.raises(ImportError, match="tview needs ROOT"):
+        Tree.tview(None, "x > 0")
@@ -7,21 +7,113 @@ from .dependencies import softimport
 import math
 import sys
 import numpy as np
-from numba import jit, prange
 
-@jit(nopython=True, parallel=True)
-def flatten(toflatten, flattening_dist, low_val):
-    flattening_dist = flattening_dist[flattening_dist >= low_val]
-    n = flattening_dist.shape[0]
-        
+def flatten(toflatten, flattening_dist, low_val, weights=None):
+    """
+    Empirical CDF of `flattening_dist` evaluated at the values of `toflatten`, i.e. the fraction
+    of the reference values lower or equal to each value. Values below `low_val` are removed
+    from both arrays. With `weights` (e.g. sWeights) the reference values are weighted.
+    """
+    
+    mask = flattening_dist >= low_val
+    flattening_dist = flattening_dist[mask]
     toflatten = toflatten[toflatten >= low_val]
-    dist = np.zeros(toflatten.shape)
-    for k in prange(dist.shape[0]):
-        v = toflatten[k]
-        dist[k] = flattening_dist[flattening_dist <= v].shape[0] / n
+    
+    if weights is None:
+        reference = np.sort(flattening_dist)
+        return np.searchsorted(reference, toflatten, side="right") / reference.shape[0]
+    else:
+        values, cdf = quantile_table(flattening_dist, low_val, weights[mask])
+        return flatten_with_table(toflatten, values, cdf)
+        
+def quantile_table(flattening_dist, low_val, weights=None):
+    """
+    Table (values, cdf) of the empirical CDF of `flattening_dist` at each of its distinct
+    values, to flatten arrays with `flatten_with_table` without the reference array.
+    """
+    
+    if weights is None:
+        weights = np.ones(flattening_dist.shape)
         
-    return dist
+    mask = flattening_dist >= low_val
+    order = np.argsort(flattening_dist[mask], kind="mergesort")
+    values = flattening_dist[mask][order]
+    cumw = np.cumsum(weights[mask][order])
     
+    # keep the last entry of each group of equal values
+    last = np.append(values[1:] != values[:-1], True)
+    
+    return values[last], cumw[last] / cumw[-1]
+    
+def flatten_with_table(toflatten, values, cdf):
+    
+    idx = np.searchsorted(values, toflatten, side="right")
+    return np.concatenate([[0.], cdf])[idx]
+    
+def flatten_chunks(chunks, values, cdf, low_val):
+    """Flatten an iterable of arrays (e.g. read in chunks) against a table from `quantile_table`."""
+    
+    for chunk in chunks:
+        yield flatten_with_table(chunk[chunk >= low_val], values, cdf)
+    
+class CDFTransform(object):
+    """
+    Flattening transformation fitted once on a reference distribution, e.g. a classifier output,
+    and applied to any number of arrays afterwards without the reference sample.
+    
+    With `nquantiles` the CDF is stored as a table of `nquantiles` quantiles, linearly interpolated,
+    otherwise the exact empirical CDF is kept and `transform` gives the same result as `flatten`.
+    
+    >>> cdf = CDFTransform.fit(reference, low_val=-1., nquantiles=1000)
+    >>> cdf.save("bdt_cdf.npz")
+    >>> flat = CDFTransform.load("bdt_cdf.npz").transform(bdt)
+    """
+    
+    def __init__(self, values, cdf, low_val, interpolate=False):
+        
+        self.values = np.asarray(values, dtype=np.float64)
+        self.cdf = np.asarray(cdf, dtype=np.float64)
+        self.low_val = low_val
+        self.interpolate = interpolate
+        
+    @classmethod
+    def fit(cls, reference, low_val, weights=None, nquantiles=None):
+        
+        values, cdf = quantile_table(reference, low_val, weights)
+        
+        if nquantiles is None or nquantiles >= len(values):
+            return cls(values, cdf, low_val)
+            
+        levels = np.linspace(0., 1., nquantiles + 1)[1:]
+        idx = np.minimum(np.searchsorted(cdf, levels), len(cdf) - 1)
+        idx = np.unique(np.concatenate([[0], idx]))
+        
+        return cls(values[idx], cdf[idx], low_val, interpolate=True)
+        
+    def transform(self, array, drop=True):
+        """Flatten `array`. With `drop` the values below `low_val` are removed as in `flatten`, else set to 0."""
+        
+        array = np.asarray(array)
+        if drop:
+            array = array[array >= self.low_val]
+            
+        if self.interpolate:
+            return np.interp(array, self.values, self.cdf, left=0., right=1.)
+        else:
+            return flatten_with_table(array, self.values, self.cdf)
+            
+    __call__ = transform
+    
+    def save(self, filename):
+        
+        np.savez(filename, values=self.values, cdf=self.cdf, low_val=self.low_val, interpolate=self.interpolate)
+        
+    @classmethod
+    def load(cls, filename):
+        
+        f = np.load(filename)
+        return cls(f["values"], f["cdf"], float(f["low_val"]), bool(f["interpolate"]))
+        
 def destruct_objects(*args):
     """Destruct an object inheriting from TObject.
 
@@ -88,62 +180,156 @@ def to_precision(x,p):
         out.append(m)
     return "".join(out)
     
-def dicttoarray( arraydict ):
+def _isawkward(array):
     
-    np     = softimport("numpy")
-    uproot = softimport("uproot")
-    awkward = softimport("awkward")
+    # awkward 1.x and later Array, without importing awkward
+    return type(array).__name__ == "Array" and type(array).__module__.split(".")[0] == "awkward"
     
-    """Convert a dictionnary into a structured array."""
+def _isjagged(array):
     
-    def jaggedtoarray(jaggedarray):
-        
-        array = np.empty(len(jaggedarray), np.object)
-        for index,a in enumerate(jaggedarray):
-            array[index] = a
+    # awkward 0.x JaggedArray, awkward 1.x+ Array with variable length lists, or object array of
+    # arrays (uproot library="np"), without importing awkward
+    if type(array).__name__ == "JaggedArray" and hasattr(array, "content"):
+        return True
+    if _isawkward(array):
+        return array.ndim > 1
     
-    names = sorted(list(arraydict.keys()))
-    formats = []
-    for n in names:
-        _array = arraydict[n]
-        try:
-            _dtype = _array.dtype
-            if len(_array.shape) > 1:
-                _shape = _array.shape[1:]
-                _dtype = np.dtype(( _dtype, _shape ))
-            else:
-                _dtype = np.dtype( _dtype )
-        except AttributeError:
-            _dtype = np.dtype(np.object)
+    return (isinstance(array, np.ndarray) and array.dtype == object and array.ndim == 1
+            and len(array) > 0 and all(isinstance(a, np.ndarray) for a in array))
+    
+class JaggedColumn(object):
+    """Variable length column stored as offsets and a flat content array."""
+    
+    def __init__(self, offsets, content):
+        
+        self.offsets = np.asarray(offsets)
+        self.content = content
+        
+    @classmethod
+    def fromjagged(cls, jagged):
+        
+        if isinstance(jagged, JaggedColumn):
+            return jagged
+        elif _isawkward(jagged):
+            awkward = softimport("awkward")
+            counts = np.asarray(awkward.num(jagged, axis=1))
+            content = np.asarray(awkward.flatten(jagged, axis=1))
+        elif _isjagged(jagged) and not isinstance(jagged, np.ndarray):
+            counts = np.asarray(jagged.counts)
+            content = jagged.flatten()
+        else:
+            counts = np.array([len(a) for a in jagged])
+            content = np.concatenate(jagged) if len(jagged) > 0 else np.empty(0)
             
-        formats.append(_dtype)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
         
-    if sys.version_info[0] > 2 and all(isinstance(n, bytes) for n in names):
-        names = [n.decode() for n in names]
-    
-    dtypes = {'names': names, 'formats': formats}
-    shape  = (len(list(arraydict.values())[0]),)
-
-    array  = np.zeros(shape,dtypes)
+        return cls(offsets, content)
+        
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
         
-    for k in arraydict.keys():
+    def __len__(self):
+        return len(self.offsets) - 1
         
-        if sys.version_info[0] > 2 and isinstance(k, bytes):
-            k_new_array = k.decode()
+    def __getitem__(self, index):
+        
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.content[self.offsets[index]:self.offsets[index+1]]
+            
+        rows = np.arange(len(self))[index]
+        starts, stops = self.offsets[rows], self.offsets[rows+1]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(stops - starts, out=offsets[1:])
+        
+        if len(rows) == 0:
+            take = np.zeros(0, dtype=np.int64)
         else:
-            k_new_array = k
-
-        if isinstance(arraydict[k], awkward.array.jagged.JaggedArray):
-            _array = jaggedtoarray(arraydict[k])
+            # indices of the content of the selected rows
+            take = np.repeat(starts - offsets[:-1], stops - starts) + np.arange(offsets[-1])
+            
+        return JaggedColumn(offsets, self.content[take])
+        
+    def toobject(self):
+        """Object array of views of the content, one per row."""
+        
+        array = np.empty(len(self), dtype=object)
+        for i in range(len(self)):
+            array[i] = self[i]
+        return array
+        
+class ColumnTable(object):
+    """
+    Table of columns wrapping a dictionary of arrays, e.g. the output of uproot `arrays()`, without
+    copying them. Jagged columns are stored as `JaggedColumn` (offsets + content). Columns are
+    accessed by name, rows or selections of rows by integer, slice or mask, and the table is
+    converted into a structured array only with `toarray`.
+    """
+    
+    def __init__(self, arraydict):
+        
+        self.columns = {}
+        for k, v in arraydict.items():
+            if isinstance(k, bytes):
+                k = k.decode()
+            if _isjagged(v):
+                v = JaggedColumn.fromjagged(v)
+            self.columns[k] = v
+            
+    def keys(self):
+        return self.columns.keys()
+        
+    def __contains__(self, name):
+        return name in self.columns
+        
+    def __iter__(self):
+        return iter(self.columns)
+        
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+        
+    def __getitem__(self, index):
+        
+        if isinstance(index, str):
+            return self.columns[index]
+        elif isinstance(index, (list, tuple)) and all(isinstance(i, str) for i in index):
+            return ColumnTable(dict((k, self.columns[k]) for k in index))
+        elif isinstance(index, (int, np.integer)):
+            return dict((k, v[index]) for k, v in self.columns.items())
         else:
-            _array = arraydict[k]
-                    
-        try:
-            array[k_new_array] = _array
-        except ValueError:
-            print(k)
-            print(type(_array))
-            print(_array)
+            return ColumnTable(dict((k, v[index]) for k, v in self.columns.items()))
+            
+    def toarray(self):
+        """Convert into a structured array, jagged columns becoming object columns."""
+        
+        names = sorted(self.columns.keys())
+        formats = []
+        for n in names:
+            _array = self.columns[n]
+            if isinstance(_array, JaggedColumn) or not hasattr(_array, "dtype"):
+                formats.append(np.dtype(object))
+            elif len(_array.shape) > 1:
+                formats.append(np.dtype((_array.dtype, _array.shape[1:])))
+            else:
+                formats.append(np.dtype(_array.dtype))
                 
-    return array
-
+        array = np.zeros((len(self),), {'names': names, 'formats': formats})
+        
+        for n in names:
+            _array = self.columns[n]
+            if isinstance(_array, JaggedColumn):
+                _array = _array.toobject()
+            array[n] = _array
+            
+        return array
+        
+def dicttoarray( arraydict ):
+    """Convert a dictionnary (or a ColumnTable) into a structured array."""
+    
+    if not isinstance(arraydict, ColumnTable):
+        arraydict = ColumnTable(arraydict)
+        
+    return arraydict.toarray()